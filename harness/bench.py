@@ -0,0 +1,182 @@
+import os
+import re
+import csv
+import glob
+import statistics
+import ctypes
+import subprocess
+from typing import Dict, List, Optional, Tuple
+
+import pyroute2
+from bcc import BPF
+
+from . import xdp_case, bpf_cache
+
+
+"""
+Packet shapes used for benchmarking,
+as arguments of XDPCase.generate_default_packets.
+"""
+PACKET_SHAPES = {
+    "udp4": {"layer_4": "udp"},
+    "tcp4": {"layer_4": "tcp"},
+    "udp6": {"layer_4": "udp", "use_inet6": True},
+    "tcp6": {"layer_4": "tcp", "use_inet6": True},
+}
+
+XDP_FUNCTION_RE = re.compile(
+    rb"^int\s+(\w+)\s*\(\s*struct\s+xdp_md\s*\*", re.MULTILINE
+)
+
+
+class BenchResult:
+    def __init__(self, function: str, shape: str, samples: List[float]):
+        self.function = function
+        self.shape = shape
+        self.samples = samples
+
+    @property
+    def ns_per_packet(self) -> float:
+        return statistics.mean(self.samples)
+
+    @property
+    def packets_per_second(self) -> float:
+        if self.ns_per_packet == 0:
+            return float("inf")
+        return 1e9 / self.ns_per_packet
+
+    @property
+    def variance(self) -> float:
+        if len(self.samples) < 2:
+            return 0.0
+        return statistics.variance(self.samples)
+
+
+def find_xdp_functions(path: str) -> List[str]:
+    """Return names of XDP functions defined in a C source file."""
+    with open(path, "rb") as source:
+        return [m.decode() for m in XDP_FUNCTION_RE.findall(source.read())]
+
+
+def get_attached_prog_fd(iface: str) -> int:
+    """Return a file descriptor of XDP program attached to an interface."""
+    ipr = pyroute2.IPRoute()
+    try:
+        link = ipr.get_links(ifname=iface)[0]
+    finally:
+        ipr.close()
+
+    xdp = link.get_attr("IFLA_XDP")
+    prog_id = xdp.get_attr("IFLA_XDP_PROG_ID") if xdp else None
+    if not prog_id:
+        raise RuntimeError("No XDP program attached to interface", iface)
+
+    lib = ctypes.CDLL("libbcc.so.0", use_errno=True)
+    fd = lib.bpf_prog_get_fd_by_id(prog_id)
+    if fd < 0:
+        raise RuntimeError("Could not get XDP program", prog_id)
+    return fd
+
+
+def bench_function(fd: int, function: str,
+                   corpus: Dict[str, List], repeat: int,
+                   rounds: int) -> List[BenchResult]:
+    """
+    Run every shape of the corpus through the XDP program.
+    Each round yields one sample, the mean duration of a packet in ns.
+    """
+    runner = xdp_case.BPTRRunner()
+    results = []
+    for (shape, packets) in corpus.items():
+        packets = [bytes(p) for p in packets]
+        samples = []
+        for _ in range(rounds):
+            durations = [runner.run(fd, p, repeat)[2] for p in packets]
+            samples.append(statistics.mean(durations))
+        results.append(BenchResult(function, shape, samples))
+    return results
+
+
+def generate_corpus(amount: int) -> Dict[str, List]:
+    """Generate packets of every shape available in the context."""
+    case = xdp_case.XDPCase
+    corpus = {}
+    for (shape, kwargs) in PACKET_SHAPES.items():
+        if kwargs.get("use_inet6") and (
+                case.get_contexts().get_local_main().inet6 is None or
+                case.get_contexts().get_remote_main().inet6 is None):
+            continue
+        corpus[shape] = case.generate_default_packets(amount=amount,
+                                                      **kwargs)
+    return corpus
+
+
+def load_xdp_filter(iface: str, mode: str = "skb",
+                    exec_path: str = "xdp-filter") -> int:
+    """Load xdp-filter on an interface and return its program."""
+    subprocess.check_output([exec_path, "load", iface, "--mode", mode],
+                            stderr=subprocess.STDOUT)
+    return get_attached_prog_fd(iface)
+
+
+def unload_xdp_filter(iface: str, exec_path: str = "xdp-filter"):
+    subprocess.run([exec_path, "unload", iface],
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def print_results(results: List[BenchResult], csv_path: Optional[str]):
+    header = ("function", "shape", "ns/packet", "packets/s", "variance")
+    rows = [(r.function, r.shape,
+             f"{r.ns_per_packet:.1f}", f"{r.packets_per_second:.0f}",
+             f"{r.variance:.1f}") for r in results]
+    print_table(header, rows, csv_path)
+
+
+def print_table(header: Tuple, rows: List[Tuple], csv_path: Optional[str]):
+    """Print rows aligned in columns, optionally save them as CSV."""
+    widths = [max(len(str(row[i])) for row in rows + [header])
+              for i in range(len(header))]
+    for row in [header] + rows:
+        print("  ".join(str(c).ljust(w) for (c, w) in zip(row, widths)))
+
+    if csv_path:
+        with open(csv_path, "w", newline="") as output:
+            writer = csv.writer(output)
+            writer.writerow(header)
+            writer.writerows(rows)
+
+
+def start_bench(ctxs, bench_args) -> int:
+    """
+    Benchmark XDP functions of programs in progs/
+    and optionally xdp-filter's program.
+    """
+    xdp_case.XDPCase = xdp_case.XDPCaseBPTR
+    xdp_case.XDPCase.set_context(ctxs)
+
+    corpus = generate_corpus(bench_args["packets"])
+    repeat = bench_args["repeat"]
+    rounds = bench_args["rounds"]
+    results = []
+
+    sources = bench_args["progs"] or sorted(glob.glob("progs/*.c"))
+    for source in sources:
+        prog = bpf_cache.load_bpf(src_file=source.encode(),
+                                  cflags=bench_args["cflags"])
+        for function in find_xdp_functions(source):
+            fd = prog.load_func(function.encode(), BPF.XDP).fd
+            results += bench_function(fd, function, corpus, repeat, rounds)
+
+    if bench_args["xdp_filter"]:
+        iface = bench_args["xdp_filter"]
+        try:
+            fd = load_xdp_filter(iface)
+            results += bench_function(fd, "xdp-filter", corpus,
+                                      repeat, rounds)
+            os.close(fd)
+        finally:
+            unload_xdp_filter(iface)
+
+    print_results(results, bench_args["csv"])
+
+    return 0
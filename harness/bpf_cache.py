@@ -0,0 +1,71 @@
+import os
+import hashlib
+import inspect
+from typing import Dict
+
+from bcc import BPF, libbcc
+
+
+"""
+Programs compiled during this run, keyed by the hash of their source,
+compiler flags and kernel version.
+"""
+_compiled: Dict[str, BPF] = {}
+
+
+def _as_bytes(value) -> bytes:
+    if isinstance(value, str):
+        return value.encode()
+    return bytes(value)
+
+
+def cache_key(*args, **kwargs) -> str:
+    """Return a key identifying a program compiled by BPF(*args, **kwargs)."""
+    bound = inspect.signature(BPF.__init__).bind(None, *args, **kwargs)
+    arguments = dict(bound.arguments)
+    arguments.pop("self")
+
+    digest = hashlib.sha256()
+    text = arguments.pop("text", None)
+    src_file = arguments.pop("src_file", b"")
+    if text:
+        digest.update(_as_bytes(text))
+    else:
+        with open(src_file, "rb") as source:
+            digest.update(source.read())
+
+    for flag in arguments.pop("cflags", []):
+        digest.update(b"\0" + _as_bytes(flag))
+
+    digest.update(b"\0" + os.uname().release.encode())
+    digest.update(b"\0" + repr(sorted(arguments.items())).encode())
+
+    return digest.hexdigest()
+
+
+def clear_tables(prog: BPF):
+    """
+    Reset all maps of a program, so that state of a previous user
+    is not seen. Maps which cannot be cleared, such as ring buffers,
+    are left as they are.
+    """
+    for i in range(libbcc.lib.bpf_num_tables(prog.module)):
+        name = libbcc.lib.bpf_table_name(prog.module, i)
+        try:
+            prog[name].clear()
+        except Exception:
+            pass
+
+
+def load_bpf(*args, **kwargs) -> BPF:
+    """
+    Compile a BPF program, unless the same source was already compiled
+    with the same flags. Compiled programs are shared by all callers,
+    their maps are cleared for every caller.
+    """
+    key = cache_key(*args, **kwargs)
+    if key not in _compiled:
+        _compiled[key] = BPF(*args, **kwargs)
+    else:
+        clear_tables(_compiled[key])
+    return _compiled[key]
@@ -0,0 +1,312 @@
+import os
+import enum
+import ctypes
+import errno
+import struct
+import platform
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+
+"""
+elixir.bootlin.com/linux/v5.6/source/arch/x86/entry/syscalls/syscall_64.tbl
+"""
+SYS_BPF = {
+    "x86_64": 321,
+    "aarch64": 280,
+    "armv7l": 386,
+    "ppc64le": 361,
+    "s390x": 351,
+}
+
+# Large enough for every known layout of union bpf_attr,
+# the kernel only requires the unknown tail to be zeroed.
+BPF_ATTR_SIZE = 256
+
+# Returned by kernels not supporting a command for a map type.
+ENOTSUPP = 524
+
+
+class BPFCommand(enum.IntEnum):
+    """
+    elixir.bootlin.com/linux/v5.6/source/include/uapi/linux/bpf.h#L74
+    """
+    BPF_MAP_LOOKUP_ELEM = 1
+    BPF_MAP_UPDATE_ELEM = 2
+    BPF_MAP_DELETE_ELEM = 3
+    BPF_MAP_GET_NEXT_KEY = 4
+    BPF_OBJ_PIN = 6
+    BPF_OBJ_GET = 7
+    BPF_PROG_TEST_RUN = 10
+    BPF_OBJ_GET_INFO_BY_FD = 15
+    BPF_MAP_LOOKUP_BATCH = 24
+    BPF_MAP_UPDATE_BATCH = 26
+    BPF_MAP_DELETE_BATCH = 27
+
+
+"""
+Flag of BPF_PROG_TEST_RUN sending frames out according to the verdict
+of the program, since Linux 5.18.
+"""
+BPF_F_TEST_XDP_LIVE_FRAMES = 1 << 1
+
+# Size of struct xdp_md passed as the context of test runs.
+XDP_MD = struct.Struct("6I")
+
+"""
+elixir.bootlin.com/linux/v5.6/source/include/uapi/linux/bpf.h#L112
+"""
+PERCPU_MAP_TYPES = (5, 6, 10)  # PERCPU_HASH, PERCPU_ARRAY, LRU_PERCPU_HASH
+ARRAY_MAP_TYPES = (2, 6)  # ARRAY, PERCPU_ARRAY
+
+
+def _libc():
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc.syscall.restype = ctypes.c_long
+    return libc
+
+
+_syscall = _libc().syscall
+
+
+def bpf(command: BPFCommand, attr: ctypes.Array) -> int:
+    """Call the bpf syscall, raise OSError on failure."""
+    res = _syscall(SYS_BPF[platform.machine()], ctypes.c_int(command),
+                   attr, ctypes.c_uint(len(attr)))
+    if res < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return res
+
+
+def _address(buffer) -> int:
+    return ctypes.addressof(buffer) if buffer is not None else 0
+
+
+def obj_pin(fd: int, path: str):
+    """Pin a map or a program in bpffs, keeping it alive without the fd."""
+    pathname = ctypes.create_string_buffer(path.encode())
+    attr = ctypes.create_string_buffer(BPF_ATTR_SIZE)
+    struct.pack_into("QI", attr, 0, _address(pathname), fd)
+    bpf(BPFCommand.BPF_OBJ_PIN, attr)
+
+
+def obj_get(path: str) -> int:
+    """Open a map or a program pinned in bpffs, return a new fd."""
+    pathname = ctypes.create_string_buffer(path.encode())
+    attr = ctypes.create_string_buffer(BPF_ATTR_SIZE)
+    struct.pack_into("Q", attr, 0, _address(pathname))
+    return bpf(BPFCommand.BPF_OBJ_GET, attr)
+
+
+def prog_id(fd: int) -> int:
+    """Return the id of a program, unique while the program is loaded."""
+    info = ctypes.create_string_buffer(8)
+    attr = ctypes.create_string_buffer(BPF_ATTR_SIZE)
+    struct.pack_into("IIQ", attr, 0, fd, len(info), _address(info))
+    bpf(BPFCommand.BPF_OBJ_GET_INFO_BY_FD, attr)
+    # struct bpf_prog_info starts with the type and the id.
+    return struct.unpack_from("I", info, 4)[0]
+
+
+def prog_test_run_live(fd: int, frame: bytes, repeat: int, ifindex: int,
+                       batch_size: int = 0) -> int:
+    """
+    Run an XDP program repeat times over a frame received on an interface,
+    letting the kernel act on every verdict, so that XDP_TX and
+    XDP_REDIRECT transmit the frame. Return the average duration
+    of a run in nanoseconds.
+    """
+    data = ctypes.create_string_buffer(frame, len(frame))
+    ctx = ctypes.create_string_buffer(XDP_MD.pack(0, len(frame), 0,
+                                                  ifindex, 0, 0))
+    attr = ctypes.create_string_buffer(BPF_ATTR_SIZE)
+    struct.pack_into("IIIIQQIIIIQQIII", attr, 0,
+                     fd, 0, len(frame), 0, _address(data), 0,
+                     repeat, 0, XDP_MD.size, 0, _address(ctx), 0,
+                     BPF_F_TEST_XDP_LIVE_FRAMES, 0, batch_size)
+    bpf(BPFCommand.BPF_PROG_TEST_RUN, attr)
+    return struct.unpack_from("I", attr, 36)[0]
+
+
+def possible_cpus() -> int:
+    """Return the number of possible CPUs, as used by per-CPU maps."""
+    with open("/sys/devices/system/cpu/possible") as possible:
+        count = 0
+        for part in possible.read().strip().split(","):
+            (first, _, last) = part.partition("-")
+            count += int(last or first) - int(first) + 1
+        return count
+
+
+class BPFMap:
+    """
+    BPF map accessed directly through the bpf syscall.
+    Keys and values are raw bytes; a value of a per-CPU map
+    contains the values of all CPUs, each aligned to 8 bytes.
+    """
+    def __init__(self, fd: int):
+        self.fd = fd
+
+        info = ctypes.create_string_buffer(80)
+        attr = ctypes.create_string_buffer(BPF_ATTR_SIZE)
+        struct.pack_into("IIQ", attr, 0, fd, len(info), _address(info))
+        bpf(BPFCommand.BPF_OBJ_GET_INFO_BY_FD, attr)
+
+        (self.map_type, self.id, self.key_size, self.value_size,
+         self.max_entries, self.map_flags) = struct.unpack_from("6I", info)
+        self.name = info.raw[24:40].rstrip(b"\0").decode()
+
+        if self.map_type in PERCPU_MAP_TYPES:
+            self.cpus = possible_cpus()
+            self.full_value_size = ((self.value_size + 7) // 8 * 8) * self.cpus
+        else:
+            self.cpus = 1
+            self.full_value_size = self.value_size
+
+    @classmethod
+    def from_pin(cls, path: str) -> "BPFMap":
+        """Open a map pinned in bpffs."""
+        return cls(obj_get(path))
+
+    def close(self):
+        os.close(self.fd)
+
+    @property
+    def is_array(self) -> bool:
+        return self.map_type in ARRAY_MAP_TYPES
+
+    def __elem(self, command: BPFCommand, key, value=None, flags: int = 0):
+        attr = ctypes.create_string_buffer(BPF_ATTR_SIZE)
+        struct.pack_into("IxxxxQQQ", attr, 0, self.fd,
+                         _address(key), _address(value), flags)
+        bpf(command, attr)
+
+    def lookup(self, key: bytes) -> Optional[bytes]:
+        key = ctypes.create_string_buffer(key, self.key_size)
+        value = ctypes.create_string_buffer(self.full_value_size)
+        try:
+            self.__elem(BPFCommand.BPF_MAP_LOOKUP_ELEM, key, value)
+        except FileNotFoundError:
+            return None
+        return value.raw
+
+    def update(self, key: bytes, value: bytes, flags: int = 0):
+        self.__elem(BPFCommand.BPF_MAP_UPDATE_ELEM,
+                    ctypes.create_string_buffer(key, self.key_size),
+                    ctypes.create_string_buffer(value, self.full_value_size),
+                    flags)
+
+    def delete(self, key: bytes):
+        self.__elem(BPFCommand.BPF_MAP_DELETE_ELEM,
+                    ctypes.create_string_buffer(key, self.key_size))
+
+    def keys(self) -> Iterator[bytes]:
+        """Iterate over keys, one syscall per key."""
+        key = None
+        next_key = ctypes.create_string_buffer(self.key_size)
+        while True:
+            try:
+                self.__elem(BPFCommand.BPF_MAP_GET_NEXT_KEY, key, next_key)
+            except FileNotFoundError:
+                return
+            yield next_key.raw
+            key = ctypes.create_string_buffer(next_key.raw, self.key_size)
+
+    def __batch(self, command: BPFCommand, keys, values, count: int,
+                in_batch=None, out_batch=None) -> Tuple[int, int]:
+        """
+        Run a batch command, return the number of processed elements
+        and an error number, which is zero on success.
+        """
+        attr = ctypes.create_string_buffer(BPF_ATTR_SIZE)
+        struct.pack_into("QQQQIIQQ", attr, 0,
+                         _address(in_batch), _address(out_batch),
+                         _address(keys), _address(values),
+                         count, self.fd, 0, 0)
+        try:
+            bpf(command, attr)
+            err = 0
+        except OSError as exception:
+            err = exception.errno
+        # The kernel reports the number of processed elements
+        # even if the command fails.
+        return (struct.unpack_from("I", attr, 32)[0], err)
+
+    def update_batch(self, items: Sequence[Tuple[bytes, bytes]]):
+        """Update many elements, using one syscall if supported."""
+        if len(items) == 0:
+            return
+
+        keys = ctypes.create_string_buffer(b"".join(
+            k.ljust(self.key_size, b"\0") for (k, _) in items
+        ))
+        values = ctypes.create_string_buffer(b"".join(
+            v.ljust(self.full_value_size, b"\0") for (_, v) in items
+        ))
+        (count, err) = self.__batch(BPFCommand.BPF_MAP_UPDATE_BATCH,
+                                    keys, values, len(items))
+        if err in (errno.EINVAL, ENOTSUPP):
+            for (key, value) in items[count:]:
+                self.update(key, value)
+        elif err:
+            raise OSError(err, os.strerror(err))
+
+    def delete_batch(self, keys: Sequence[bytes]):
+        """Delete many elements, missing ones are ignored."""
+        if len(keys) == 0:
+            return
+
+        buffer = ctypes.create_string_buffer(b"".join(
+            k.ljust(self.key_size, b"\0") for k in keys
+        ))
+        (count, err) = self.__batch(BPFCommand.BPF_MAP_DELETE_BATCH,
+                                    buffer, None, len(keys))
+        if err in (errno.EINVAL, ENOTSUPP, errno.ENOENT):
+            # A missing element stops the batch, continue one by one.
+            for key in keys[count:]:
+                try:
+                    self.delete(key)
+                except FileNotFoundError:
+                    pass
+        elif err:
+            raise OSError(err, os.strerror(err))
+
+    def items(self, chunk: int = 4096) -> List[Tuple[bytes, bytes]]:
+        """Read all elements, using few syscalls if supported."""
+        items = []
+        token_size = max(self.key_size, 8)
+        in_batch = None
+        out_batch = ctypes.create_string_buffer(token_size)
+        keys = ctypes.create_string_buffer(self.key_size * chunk)
+        values = ctypes.create_string_buffer(self.full_value_size * chunk)
+
+        while True:
+            (count, err) = self.__batch(BPFCommand.BPF_MAP_LOOKUP_BATCH,
+                                        keys, values, chunk,
+                                        in_batch, out_batch)
+            if err in (errno.EINVAL, ENOTSUPP) and in_batch is None:
+                return self.__items_one_by_one()
+            if err and err != errno.ENOENT:
+                raise OSError(err, os.strerror(err))
+
+            raw_keys = keys.raw
+            raw_values = values.raw
+            for i in range(count):
+                items.append((
+                    raw_keys[i * self.key_size:(i + 1) * self.key_size],
+                    raw_values[i * self.full_value_size:
+                               (i + 1) * self.full_value_size],
+                ))
+
+            # ENOENT marks the last batch.
+            if err == errno.ENOENT:
+                return items
+            in_batch = ctypes.create_string_buffer(out_batch.raw, token_size)
+
+    def __items_one_by_one(self) -> List[Tuple[bytes, bytes]]:
+        items = []
+        for key in self.keys():
+            value = self.lookup(key)
+            if value is not None:
+                items.append((key, value))
+        return items
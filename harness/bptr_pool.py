@@ -0,0 +1,130 @@
+import os
+import glob
+import multiprocessing
+from typing import Callable, List, Optional, Tuple
+
+from . import bpf_syscall, redirect_events
+
+
+"""
+Directory in bpffs where programs run by worker processes are pinned.
+"""
+PIN_DIRECTORY = "/sys/fs/bpf"
+
+# Number of chunks given to every worker, balancing uneven run times.
+CHUNKS_PER_JOB = 4
+# Largest chunk, so that events of chunks finished between two calls
+# of on_chunk fit into the ring buffer of the redirect probe.
+MAX_CHUNK = 1024
+
+
+"""
+Runner and program of a worker process, set by _init_worker.
+"""
+_worker = {}
+
+"""
+Return value, output, duration and the identifier of a test run,
+if runs are counted by a redirect probe.
+"""
+RunResult = Tuple[int, bytes, int, Optional[redirect_events.RunId]]
+
+
+def remove_stale_pins():
+    """Remove programs and maps pinned by pools of exited processes."""
+    for path in glob.glob(os.path.join(PIN_DIRECTORY, "xdp_test_*")):
+        pid = os.path.basename(path).split("_")[2]
+        if pid.isdigit() and not os.path.exists(f"/proc/{pid}"):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+def _init_worker(path: str, runs_path: Optional[str]):
+    # Imported here, since xdp_case imports this module.
+    from .xdp_case import BPTRRunner
+    _worker["runner"] = BPTRRunner()
+    _worker["fd"] = bpf_syscall.obj_get(path)
+    _worker["runs"] = None
+    if runs_path is not None:
+        _worker["runs"] = bpf_syscall.BPFMap.from_pin(runs_path)
+
+
+def _run_chunk(frames: List[bytes]) -> List[RunResult]:
+    runner = _worker["runner"]
+    runs = _worker["runs"]
+    if runs is not None:
+        pid_tgid = redirect_events.current_thread()
+        seq = redirect_events.read_sequence(runs, pid_tgid)
+
+    results = []
+    for frame in frames:
+        (retval, out, duration) = runner.run(_worker["fd"], frame)
+        run = None
+        if runs is not None:
+            seq += 1
+            run = (pid_tgid, seq)
+        results.append((retval, bytes(out), duration, run))
+    return results
+
+
+class BPTRPool:
+    """
+    Runs frames through an XDP program using BPF_PROG_TEST_RUN command
+    in worker processes. The program is pinned in bpffs and opened by
+    every worker, results are returned in order of the frames.
+    Test runs are identified if the map counting them is given.
+    The pool belongs to the program of prog_id, fds of closed programs
+    are reused by new ones.
+    """
+    def __init__(self, fd: int, jobs: int = os.cpu_count(),
+                 runs: Optional[bpf_syscall.BPFMap] = None):
+        self.fd = fd
+        self.prog_id = bpf_syscall.prog_id(fd)
+        self.jobs = jobs
+        # Pins of killed processes are left behind, remove them.
+        remove_stale_pins()
+        self.path = os.path.join(PIN_DIRECTORY,
+                                 f"xdp_test_{os.getpid()}_{self.prog_id}")
+        self.runs_path = None
+        bpf_syscall.obj_pin(fd, self.path)
+        try:
+            if runs is not None:
+                self.runs_path = self.path + "_runs"
+                bpf_syscall.obj_pin(runs.fd, self.runs_path)
+            self.pool = multiprocessing.Pool(jobs, _init_worker,
+                                             (self.path, self.runs_path))
+        except Exception:
+            self.__unpin()
+            raise
+
+    def __unpin(self):
+        for path in (self.path, self.runs_path):
+            if path is not None and os.path.exists(path):
+                os.unlink(path)
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+        self.__unpin()
+
+    def run(self, frames,
+            on_chunk: Optional[Callable[[], None]] = None) -> List[RunResult]:
+        """
+        Run frames through the program, return the return value,
+        the output, the duration in nanoseconds and the identifier
+        of the test run of every frame. on_chunk is called after
+        every chunk of frames, to drain events of the test runs.
+        """
+        frames = [bytes(f) for f in frames]
+        chunk = max(1, -(-len(frames) // (self.jobs * CHUNKS_PER_JOB)))
+        chunk = min(chunk, MAX_CHUNK)
+        chunks = [frames[i:i + chunk] for i in range(0, len(frames), chunk)]
+
+        results = []
+        for chunk_results in self.pool.imap(_run_chunk, chunks):
+            results.extend(chunk_results)
+            if on_chunk is not None:
+                on_chunk()
+        return results
@@ -1,51 +1,77 @@
 #include <linux/bpf.h>
 
 
-struct redirect_map_info {
+enum redirect_kind {
+	REDIRECT = 1,
+	REDIRECT_MAP = 2,
+};
+
+struct redirect_event {
+	u64 pid_tgid;
+	u64 seq;
 	u64 ifindex;
-	u64 map_type;
+	u32 kind;
+	u32 map_type;
 	char map_name[BPF_OBJ_NAME_LEN];
 };
-BPF_ARRAY(redirect_map_info, struct redirect_map_info, 1);
-BPF_ARRAY(redirect_map_activated, bool, 1);
+BPF_RINGBUF_OUTPUT(events, 4096);
+BPF_ARRAY(lost, u64, 1);
 
-int bpf_xdp_redirect_map(struct pt_regs *ctx,
-			 struct bpf_map *map,
-			 u32 ifindex, u64 flags)
+/* Number of test runs started by every thread, old threads are evicted. */
+BPF_TABLE("lru_hash", u64, u64, runs, 4096);
+
+int count_run(struct pt_regs *ctx)
+{
+	u64 pid_tgid = bpf_get_current_pid_tgid();
+	u64 zero_value = 0;
+
+	u64 *seq = runs.lookup_or_try_init(&pid_tgid, &zero_value);
+	if (seq)
+		__sync_fetch_and_add(seq, 1);
+
+	return 0;
+}
+
+static void emit(struct redirect_event *event)
 {
 	int zero_value = 0;
-	bool true_value = 1;
 
-	redirect_map_activated.update(&zero_value, &true_value);
+	event->pid_tgid = bpf_get_current_pid_tgid();
+	u64 *seq = runs.lookup(&event->pid_tgid);
+	if (!seq)
+		return;
+	event->seq = *seq;
 
-	struct redirect_map_info info;
-	info.ifindex = ifindex;
-	info.map_type = map->map_type;
-	bpf_probe_read_str(info.map_name, BPF_OBJ_NAME_LEN, map->name);
+	if (events.ringbuf_output(event, sizeof(*event), 0) < 0) {
+		u64 *count = lost.lookup(&zero_value);
+		if (count)
+			__sync_fetch_and_add(count, 1);
+	}
+}
+
+int bpf_xdp_redirect_map(struct pt_regs *ctx,
+			 struct bpf_map *map,
+			 u32 ifindex, u64 flags)
+{
+	struct redirect_event event = {};
 
-	redirect_map_info.update(&zero_value, &info);
+	event.kind = REDIRECT_MAP;
+	event.ifindex = ifindex;
+	event.map_type = map->map_type;
+	bpf_probe_read_str(event.map_name, BPF_OBJ_NAME_LEN, map->name);
+	emit(&event);
 
 	return 0;
 }
 
-struct redirect_info {
-	u64 ifindex;
-};
-BPF_ARRAY(redirect_info, struct redirect_info, 1);
-BPF_ARRAY(redirect_activated, bool, 1);
-
 int bpf_xdp_redirect(struct pt_regs *ctx,
 		     u32 ifindex, u64 flags)
 {
-	int zero_value = 0;
-	bool true_value = 1;
-
-	redirect_activated.update(&zero_value, &true_value);
-
-	struct redirect_info info;
-	info.ifindex = ifindex;
+	struct redirect_event event = {};
 
-	redirect_info.update(&zero_value, &info);
+	event.kind = REDIRECT;
+	event.ifindex = ifindex;
+	emit(&event);
 
 	return 0;
 }
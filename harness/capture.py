@@ -0,0 +1,181 @@
+import mmap
+import select
+import socket
+import struct
+import threading
+import time
+from typing import Callable, List, Optional
+
+from . import utils
+
+
+"""
+Defined in if_packet.h and if_ether.h.
+"""
+SOL_PACKET = 263
+PACKET_ADD_MEMBERSHIP = 1
+PACKET_RX_RING = 5
+PACKET_VERSION = 10
+PACKET_IGNORE_OUTGOING = 23
+PACKET_MR_PROMISC = 1
+TPACKET_V3 = 2
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+ETH_P_ALL = 3
+
+"""
+Offsets of fields in struct tpacket_block_desc and struct tpacket3_hdr.
+"""
+BLOCK_STATUS_OFFSET = 8
+PKT_NEXT_OFFSET = 0
+PKT_SNAPLEN_OFFSET = 12
+PKT_MAC_OFFSET = 24
+
+
+class RingCapture:
+    """
+    Captures incoming frames on an interface using a TPACKET_V3 ring
+    shared with the kernel. Frames are collected in batches, one retired
+    block at a time, as raw bytes without any dissection.
+    If on_frames is given, each batch is passed to it instead of being
+    kept in results.
+    """
+    def __init__(self, iface: str,
+                 block_size: int = 1 << 20, block_nr: int = 32,
+                 frame_size: int = 2048, retire_blk_tov: int = 10,
+                 on_frames: Optional[Callable[[List[bytes]], None]] = None):
+        self.iface = iface
+        self.on_frames = on_frames
+        self.block_size = block_size
+        self.block_nr = block_nr
+        self.retire_blk_tov = retire_blk_tov
+
+        self.results: List[bytes] = []
+        self.arrivals = utils.ArrivalTracker()
+
+        self.sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, 0)
+        try:
+            self.sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+            self.sock.setsockopt(SOL_PACKET, PACKET_IGNORE_OUTGOING, 1)
+            self.sock.setsockopt(SOL_PACKET, PACKET_RX_RING, struct.pack(
+                "7I",
+                block_size, block_nr,
+                frame_size, block_size * block_nr // frame_size,
+                retire_blk_tov, 0, 0,
+            ))
+            self.ring = mmap.mmap(self.sock.fileno(), block_size * block_nr,
+                                  mmap.MAP_SHARED,
+                                  mmap.PROT_READ | mmap.PROT_WRITE)
+
+            ifindex = socket.if_nametoindex(iface)
+            self.sock.setsockopt(SOL_PACKET, PACKET_ADD_MEMBERSHIP,
+                                 struct.pack("iHH8s", ifindex,
+                                             PACKET_MR_PROMISC, 0, b""))
+            self.sock.bind((iface, ETH_P_ALL))
+        except OSError:
+            self.sock.close()
+            raise
+
+        self.block = 0
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+        self.thread.start()
+
+    @property
+    def running(self) -> bool:
+        return self.thread.is_alive()
+
+    def stop(self):
+        """Stop capturing, collect frames that are still in the ring."""
+        self.stopping.set()
+        self.thread.join()
+
+        self.__wait_for_retirement()
+        self.__read_blocks()
+
+        self.ring.close()
+        self.sock.close()
+
+    def __block_offset(self, block: int) -> int:
+        return block * self.block_size
+
+    def __run(self):
+        poller = select.poll()
+        poller.register(self.sock, select.POLLIN | select.POLLERR)
+
+        while not self.stopping.is_set():
+            poller.poll(self.retire_blk_tov * 2)
+            self.__read_blocks()
+
+    def __wait_for_retirement(self):
+        """
+        Wait until the block being filled by the kernel gets retired,
+        unless it is empty.
+        """
+        poller = select.poll()
+        poller.register(self.sock, select.POLLIN)
+
+        offset = self.__block_offset(self.block)
+        deadline = time.monotonic() + self.retire_blk_tov * 10 / 1000
+        while True:
+            (status, num_pkts) = struct.unpack_from(
+                "II", self.ring, offset + BLOCK_STATUS_OFFSET
+            )
+            remaining = deadline - time.monotonic()
+            if status & TP_STATUS_USER or num_pkts == 0 or remaining <= 0:
+                return
+            poller.poll(remaining * 1000)
+
+    def __read_blocks(self):
+        """Collect frames of all blocks retired to the user."""
+        while True:
+            offset = self.__block_offset(self.block)
+            (status, num_pkts, first_pkt) = struct.unpack_from(
+                "III", self.ring, offset + BLOCK_STATUS_OFFSET
+            )
+            if not status & TP_STATUS_USER:
+                return
+
+            batch = []
+            pkt = offset + first_pkt
+            for _ in range(num_pkts):
+                (next_offset, ) = struct.unpack_from(
+                    "I", self.ring, pkt + PKT_NEXT_OFFSET
+                )
+                (snaplen, ) = struct.unpack_from(
+                    "I", self.ring, pkt + PKT_SNAPLEN_OFFSET
+                )
+                (mac, ) = struct.unpack_from(
+                    "H", self.ring, pkt + PKT_MAC_OFFSET
+                )
+                batch.append(self.ring[pkt + mac:pkt + mac + snaplen])
+                pkt += next_offset
+
+            struct.pack_into("I", self.ring, offset + BLOCK_STATUS_OFFSET,
+                             TP_STATUS_KERNEL)
+            self.block = (self.block + 1) % self.block_nr
+
+            if self.on_frames is None:
+                self.results.extend(batch)
+            elif batch:
+                self.on_frames(batch)
+            self.arrivals(amount=len(batch))
+
+
+def start_capture(iface: str,
+                  on_frames: Optional[Callable[[List[bytes]], None]] = None):
+    """
+    Start capturing incoming frames on an interface, optionally passing
+    them to on_frames as they arrive instead of keeping them.
+    Falls back to AsyncSniffer if the kernel does not support TPACKET_V3
+    or PACKET_IGNORE_OUTGOING.
+    """
+    try:
+        return RingCapture(iface, on_frames=on_frames)
+    except OSError:
+        if on_frames is None:
+            return utils.wait_for_async_sniffing(iface=iface)
+        return utils.wait_for_async_sniffing(
+            iface=iface, store=False,
+            prn=lambda packet: on_frames([bytes(packet)])
+        )
@@ -1,32 +1,230 @@
 #!/usr/bin/env python3
 
+import os
 import sys
+import json
 import unittest
 import pickle
+import subprocess
+import tempfile
+from typing import Dict, List
 
-from . import xdp_case
+from . import xdp_case, timing
+
+
+def load_suite(unittest_args) -> unittest.TestSuite:
+    if unittest_args["tests"]:
+        return unittest.defaultTestLoader.loadTestsFromNames(
+            map(lambda s: "tests." + s, unittest_args["tests"])
+        )
+    return unittest.defaultTestLoader.discover("tests")
+
+
+def iterate_tests(suite: unittest.TestSuite):
+    for test in suite:
+        if isinstance(test, unittest.TestSuite):
+            yield from iterate_tests(test)
+        else:
+            yield test
+
+
+class RuntimeTestResult(timing.TimingTestResult):
+    """Collects run times of XDP programs measured by tests."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.runtime_histograms = {}
+
+    def stopTest(self, test):
+        histogram = getattr(test, "xdp_runtime", None)
+        if histogram:
+            self.runtime_histograms[test.id()] = histogram
+            if self.showAll:
+                self.stream.writeln(f"  {histogram.summary()}")
+        super().stopTest(test)
+
+
+def write_report(path: str, res: unittest.TestResult):
+    """Write a summary of a finished test run as JSON."""
+    report = {
+        "run": res.testsRun,
+        "failures": [(t.id(), tb) for (t, tb) in res.failures],
+        "errors": [(t.id(), tb) for (t, tb) in res.errors],
+        "skipped": len(res.skipped),
+        "expected_failures": len(res.expectedFailures),
+        "unexpected_successes": len(res.unexpectedSuccesses),
+        "runtime_histograms": {
+            test_id: histogram.to_dict() for (test_id, histogram)
+            in getattr(res, "runtime_histograms", {}).items()
+        },
+    }
+    with open(path, "w") as output:
+        json.dump(report, output)
 
 
 def start_client(ctx, target_xdp_case, unittest_args=None):
     xdp_case.XDPCase = target_xdp_case
     xdp_case.XDPCase.set_context(ctx)
+    xdp_case.XDPCase.measure_runtime = unittest_args.get("histograms", False)
+    xdp_case.XDPCase.use_counters = unittest_args.get("counters", False)
+    xdp_case.XDPCase.jobs = unittest_args.get("bptr_jobs", 1)
     xdp_case.XDPCase.prepare_class()
 
     # delayed tests.py -- this prevents having to hack the bases of the XDPCase
     # and postpones the evaluation of decorators (e.g. unittest.skipIf), but
     # this is also kinda hacky...
-    if unittest_args["tests"]:
-        suite = unittest.defaultTestLoader.loadTestsFromNames(
-            map(lambda s: "tests." + s, unittest_args["tests"])
-        )
-    else:
-        suite = unittest.defaultTestLoader.discover("tests")
-    runner = unittest.TextTestRunner(verbosity=3)
+    suite = load_suite(unittest_args)
+    runner = timing.TimingTestRunner(
+        verbosity=3, resultclass=RuntimeTestResult,
+        profile=unittest_args.get("profile"),
+        slowest=unittest_args.get("slowest", 0)
+    )
     res = runner.run(suite)
 
+    if unittest_args.get("report"):
+        write_report(unittest_args["report"], res)
+
     return len(res.failures)
 
 
+def split_test_classes(ctx, target_xdp_case, unittest_args,
+                       jobs: int) -> List[List[str]]:
+    """
+    Split test classes to at most jobs groups
+    with a similar amount of tests in each.
+    """
+    xdp_case.XDPCase = target_xdp_case
+    xdp_case.XDPCase.set_context(ctx)
+
+    counts: Dict[str, int] = {}
+    for test in iterate_tests(load_suite(unittest_args)):
+        test_id = test.id()
+        if test_id.startswith("unittest.loader._FailedTest."):
+            # Let the shard report the error of loading the module.
+            name = test_id[len("unittest.loader._FailedTest."):]
+        else:
+            name = test_id[len("tests."):].rsplit(".", 1)[0]
+        counts[name] = counts.get(name, 0) + 1
+
+    groups = [[] for _ in range(min(jobs, len(counts)))]
+    sizes = [0] * len(groups)
+    for name in sorted(counts, key=counts.get, reverse=True):
+        smallest = sizes.index(min(sizes))
+        groups[smallest].append(name)
+        sizes[smallest] += counts[name]
+
+    return groups
+
+
+def start_sharded_client(ctx, target_xdp_case, unittest_args, jobs: int):
+    """
+    Run test classes in parallel, each group in a separate network namespace
+    with its own virtual servers, and merge the results.
+    """
+    groups = split_test_classes(ctx, target_xdp_case, unittest_args, jobs)
+    profiling = unittest_args.get("profile") or unittest_args.get("slowest")
+
+    shards = []
+    try:
+        for (i, group) in enumerate(groups):
+            netns = f"xdp_shard_{i}"
+            with tempfile.NamedTemporaryFile(suffix=".json",
+                                             delete=False) as report:
+                report_path = report.name
+            log = tempfile.TemporaryFile()
+
+            # A namespace may be left over by an interrupted run.
+            subprocess.run(["ip", "netns", "delete", netns],
+                           stderr=subprocess.DEVNULL)
+            subprocess.run(["ip", "netns", "add", netns], check=True)
+            command = " ".join(
+                ["mount bpffs /sys/fs/bpf -t bpf &&",
+                 "./run.py client",
+                 "--shard-id", str(i),
+                 "--report", report_path] +
+                (["--histograms"] if unittest_args.get("histograms")
+                 else []) +
+                (["--counters"] if unittest_args.get("counters") else []) +
+                (["--profile", report_path + ".profile"] if profiling
+                 else []) +
+                group
+            )
+            proc = subprocess.Popen(
+                ["ip", "netns", "exec", netns, "sh", "-c", command],
+                stdout=log, stderr=subprocess.STDOUT
+            )
+            shards.append((netns, proc, report_path, log))
+
+        failures = 0
+        merged = {"run": 0, "failures": [], "errors": [], "skipped": 0,
+                  "expected_failures": 0, "unexpected_successes": 0,
+                  "runtime_histograms": {}}
+        profiles = []
+        for (i, (_, proc, report, log)) in enumerate(shards):
+            proc.wait()
+
+            log.seek(0)
+            print(f"===== shard {i}: {' '.join(groups[i])} =====")
+            sys.stdout.flush()
+            sys.stdout.buffer.write(log.read())
+            sys.stdout.flush()
+
+            try:
+                with open(report) as source:
+                    shard_report = json.load(source)
+            except (OSError, ValueError):
+                print(f"Shard {i} did not produce a report.")
+                failures += 1
+                continue
+
+            for (key, value) in shard_report.items():
+                if isinstance(value, dict):
+                    merged[key].update(value)
+                else:
+                    merged[key] += value
+            failures += len(shard_report["failures"])
+
+            if profiling:
+                with open(report + ".profile") as source:
+                    profiles.append(json.load(source))
+    finally:
+        for (netns, proc, report, log) in shards:
+            if proc.poll() is None:
+                proc.terminate()
+                proc.wait()
+            log.close()
+            os.remove(report)
+            if os.path.exists(report + ".profile"):
+                os.remove(report + ".profile")
+            subprocess.run(["ip", "netns", "delete", netns])
+
+    print(f"===== merged results of {len(shards)} shards =====")
+    for (test_id, _) in merged["failures"]:
+        print(f"FAIL: {test_id}")
+    for (test_id, _) in merged["errors"]:
+        print(f"ERROR: {test_id}")
+    print(f"Ran {merged['run']} tests "
+          f"(failures={len(merged['failures'])}, "
+          f"errors={len(merged['errors'])}, "
+          f"skipped={merged['skipped']}, "
+          f"expected failures={merged['expected_failures']}, "
+          f"unexpected successes={merged['unexpected_successes']})")
+
+    if unittest_args.get("report"):
+        with open(unittest_args["report"], "w") as output:
+            json.dump(merged, output)
+
+    if profiling:
+        profile = timing.merge_profiles(profiles)
+        if unittest_args.get("profile"):
+            with open(unittest_args["profile"], "w") as output:
+                json.dump(profile, output, indent=1)
+        if unittest_args.get("slowest"):
+            timing.print_slowest(profile, unittest_args["slowest"],
+                                 sys.stdout)
+
+    return failures
+
+
 if __name__ == "__main__":
     sys.exit(start_client(pickle.loads(sys.argv[1].encode()),
                           pickle.loads(sys.argv[2].encode())))
@@ -0,0 +1,250 @@
+import json
+import time
+import collections
+import dataclasses
+from typing import Dict, List, Tuple
+
+import numpy as np
+from bcc import BPF
+
+from . import xdp_case, verifier, bptr_pool
+
+
+"""
+Flow shapes of generated corpora, as arguments of generate_template_packets.
+"""
+SHAPES = (
+    {"layer_4": "udp"},
+    {"layer_4": "tcp"},
+    {"layer_4": "udp", "use_inet6": True},
+    {"layer_4": "tcp", "use_inet6": True},
+)
+
+# Destination of a packet dropped or aborted by the program.
+DROPPED = "dropped"
+
+
+@dataclasses.dataclass
+class Mismatch:
+    """A packet processed differently by the backends."""
+    case: int
+    packet: str
+    bptr: str
+    network: str
+    output: str
+
+    @classmethod
+    def of(cls, case: int, frame: bytes, bptr: str, network: str,
+           output: bytes) -> "Mismatch":
+        return cls(case, frame.hex(), bptr, network, output.hex())
+
+    def to_json(self) -> str:
+        return json.dumps(dataclasses.asdict(self))
+
+
+def describe_destination(destination) -> str:
+    if destination is verifier.LOCAL:
+        return "passed"
+    if destination == DROPPED:
+        return DROPPED
+    return f"sent to server {destination}"
+
+
+def generate_corpus(rng: np.random.Generator, first_case: int, count: int,
+                    shape: Dict) -> List[bytes]:
+    """
+    Generate frames of one shape with random ports and, for IPv4,
+    random source addresses. Every frame carries its case number.
+    """
+    batch = xdp_case.XDPCase.generate_template_packets(
+        count, first_seq=first_case, **shape
+    )
+    fields = {
+        "src_port": rng.integers(0, 1 << 16, count, dtype=np.uint32),
+        "dst_port": rng.integers(0, 1 << 16, count, dtype=np.uint32),
+    }
+    if not shape.get("use_inet6"):
+        fields["src_inet"] = rng.integers(0, 1 << 32, count, dtype=np.uint32)
+    batch.patch(**fields)
+    return [bytes(f) for f in batch]
+
+
+class Campaign:
+    """
+    Runs corpora through both backends and compares where every packet
+    ended up and its bytes. Packets are run by BPTR in worker processes,
+    targets of redirects are read from events of the redirect probe.
+    """
+    def __init__(self, diff_args):
+        self.args = diff_args
+        self.cases = 0
+        self.mismatches = 0
+        self.unattributed = 0
+        self.output = None
+
+        xdp_case.XDPCaseBPTR.prepare_class()
+        xdp_case.XDPCaseBPTR.setUpClass()
+        prog = xdp_case.XDPCaseBPTR.load_bpf(
+            src_file=diff_args["prog"].encode(), cflags=diff_args["cflags"]
+        )
+        self.bptr = xdp_case.XDPCaseBPTR()
+        self.bptr.attach_xdp(diff_args["function"])
+        self.pool = bptr_pool.BPTRPool(
+            prog.load_func(diff_args["function"].encode(), BPF.XDP).fd,
+            diff_args["jobs"], xdp_case.XDPCaseBPTR.redirect_probe.runs
+        )
+
+        xdp_case.XDPCaseNetwork.prepare_class()
+        xdp_case.XDPCaseNetwork.setUpClass()
+        xdp_case.XDPCaseNetwork.load_bpf(src_file=diff_args["prog"].encode(),
+                                         cflags=diff_args["cflags"])
+        self.network = xdp_case.XDPCaseNetwork()
+        self.network.attach_xdp(diff_args["function"])
+
+    def close(self):
+        self.pool.close()
+        xdp_case.XDPCaseNetwork.tearDownClass()
+        xdp_case.XDPCaseNetwork.sessions.close()
+
+    def run_bptr(self, frames: List[bytes]) -> List[Tuple[object, bytes]]:
+        """Return the destination and the output of every frame."""
+        probe = xdp_case.XDPCaseBPTR.redirect_probe
+        results = self.pool.run(frames, probe.drain)
+        events = probe.collect()
+
+        destinations = []
+        for (retval, out, _, run) in results:
+            if retval == BPF.XDP_PASS:
+                destinations.append((verifier.LOCAL, out))
+            elif retval == BPF.XDP_TX:
+                destinations.append((0, out))
+            elif retval == BPF.XDP_REDIRECT:
+                destinations.append(self.resolve_redirect(events.get(run),
+                                                          out))
+            else:
+                destinations.append((DROPPED, out))
+        return destinations
+
+    def resolve_redirect(self, event, out: bytes) -> Tuple[object, bytes]:
+        servers = self.bptr.get_contexts().server_count()
+        (passed, redirected) = ([], [[] for _ in range(servers)])
+        self.bptr.handle_redirect(event, out, passed, redirected)
+        if passed:
+            return (verifier.LOCAL, out)
+        for (i, captured) in enumerate(redirected):
+            if captured:
+                return (i, out)
+        return (DROPPED, out)
+
+    def run_network(self, frames: List[bytes]) -> Dict[object, List[bytes]]:
+        """Return frames captured on every interface."""
+        result = self.network.send_packets(frames)
+        captured = {verifier.LOCAL: [bytes(f) for f in result.captured_local]}
+        for (i, frames) in enumerate(result.captured_remote):
+            captured[i] = [bytes(f) for f in frames]
+        return captured
+
+    def compare(self, first_case: int, frames: List[bytes],
+                expected: List[Tuple[object, bytes]],
+                captured: Dict[object, List[bytes]]) -> List[Mismatch]:
+        """
+        Compare frames captured on every interface with outputs of BPTR.
+        Frames are matched by their bytes, so reordering is not reported.
+        """
+        observed = {d: collections.Counter(f) for (d, f) in captured.items()}
+        inputs = {bytes(f): i for (i, f) in enumerate(frames)}
+
+        mismatches = []
+        unmatched = []
+        for (i, (destination, out)) in enumerate(expected):
+            if destination == DROPPED:
+                continue
+            counter = observed.get(destination, collections.Counter())
+            if counter[out] > 0:
+                counter[out] -= 1
+            else:
+                unmatched.append(i)
+
+        # Frames left were not expected, find where the packets went.
+        extra = {}
+        for (destination, counter) in observed.items():
+            for (frame, count) in counter.items():
+                for _ in range(count):
+                    extra.setdefault(frame, []).append(destination)
+
+        for i in unmatched:
+            (destination, out) = expected[i]
+            network = "not observed"
+            if extra.get(out):
+                network = describe_destination(extra[out].pop())
+            mismatches.append(Mismatch.of(first_case + i, frames[i],
+                                          describe_destination(destination),
+                                          network, out))
+
+        for (frame, destinations) in extra.items():
+            for destination in destinations:
+                i = inputs.get(frame)
+                if i is None or expected[i][0] != DROPPED:
+                    self.unattributed += 1
+                    continue
+                mismatches.append(Mismatch.of(
+                    first_case + i, frames[i], DROPPED,
+                    describe_destination(destination), frame
+                ))
+
+        return mismatches
+
+    def run(self) -> int:
+        rng = np.random.default_rng(self.args["seed"])
+        shapes = [s for s in SHAPES if not s.get("use_inet6") or (
+            xdp_case.XDPCase.get_contexts().get_local_main().inet6 and
+            xdp_case.XDPCase.get_contexts().get_remote_main().inet6
+        )]
+
+        start = time.monotonic()
+        batch_index = 0
+        while self.cases < self.args["cases"]:
+            count = min(self.args["batch"], self.args["cases"] - self.cases)
+            shape = shapes[batch_index % len(shapes)]
+            frames = generate_corpus(rng, self.cases, count, shape)
+
+            expected = self.run_bptr(frames)
+            captured = self.run_network(frames)
+            for mismatch in self.compare(self.cases, frames,
+                                         expected, captured):
+                self.report(mismatch)
+
+            self.cases += count
+            batch_index += 1
+            elapsed = time.monotonic() - start
+            print(f"{self.cases} cases, {self.mismatches} mismatches, "
+                  f"{self.unattributed} unattributed frames, "
+                  f"{self.cases / elapsed:.0f} cases/s", flush=True)
+
+        return self.mismatches
+
+    def report(self, mismatch: Mismatch):
+        self.mismatches += 1
+        if self.mismatches <= self.args["max_reports"]:
+            print(f"case {mismatch.case}: BPTR {mismatch.bptr}, "
+                  f"network {mismatch.network}: {mismatch.packet}")
+        if self.output is not None:
+            self.output.write(mismatch.to_json() + "\n")
+
+
+def start_differential(ctxs, diff_args) -> int:
+    """
+    Run a differential campaign between the BPTR and network backends,
+    return the number of mismatches found.
+    """
+    xdp_case.XDPCase.set_context(ctxs)
+
+    campaign = Campaign(diff_args)
+    try:
+        if diff_args["output"]:
+            campaign.output = open(diff_args["output"], "w")
+        return campaign.run()
+    finally:
+        if campaign.output is not None:
+            campaign.output.close()
+        campaign.close()
@@ -0,0 +1,158 @@
+import os
+import ipaddress
+from typing import Dict, List, Tuple
+
+from . import xdp_case, xdp_filter, bench, capture, utils, wire
+
+
+"""
+Modes xdp-filter is loaded in, by their names used by xdp-filter.
+"""
+FILTER_MODES = ("native", "skb")
+
+"""
+Number of rules of every kind, capped by the size of the map.
+"""
+RULE_COUNTS = (1, 10, 1000, 65536)
+
+"""
+Destination port of packets passed by the filter and of packets dropped
+by it. The port of dropped packets is the first rule of every configuration,
+other rules never match any packet.
+"""
+PASS_PORT = 50000
+DROP_PORT = 1
+
+CSV_HEADER = (
+    "mode", "port_rules", "ip_rules", "ether_rules",
+    "sent", "received", "dropped", "seconds", "receive seconds",
+    "received/s", "dropped/s", "cpu ns/packet",
+)
+
+
+def generate_rules(kind: str, count: int) -> List[str]:
+    """
+    Generate addresses of rules, none matching the packets sent,
+    except for the first port rule.
+    """
+    if kind == "port":
+        ports = [p for p in range(DROP_PORT + 1, 1 << 16) if p != PASS_PORT]
+        return [str(DROP_PORT)] + [str(p) for p in ports[:count - 1]]
+    if kind == "ip":
+        first = int(ipaddress.IPv4Address("10.0.0.0"))
+        return [str(ipaddress.IPv4Address(first + i)) for i in range(count)]
+    if kind == "ether":
+        return [":".join(["02", "00"] + [format(b, "02x") for b in
+                                         i.to_bytes(4, "big")])
+                for i in range(count)]
+    raise ValueError("Unknown kind of rule", kind)
+
+
+def fill_filter(maps: xdp_filter.XDPFilterMaps,
+                count: int) -> Dict[str, int]:
+    """
+    Replace rules of every kind by count new ones, or as many as fit
+    into the map. Return the number of rules of every kind.
+    """
+    maps.clear()
+    counts = {}
+    for (kind, map_names) in xdp_filter.MAP_NAMES.items():
+        bpf_map = maps.get_map(map_names[0])
+        if bpf_map is None:
+            counts[kind] = 0
+            continue
+        rules = generate_rules(kind, min(count, bpf_map.max_entries))
+        maps.add(kind, rules)
+        counts[kind] = len(rules)
+    return counts
+
+
+def generate_traffic(amount: int, distinct: int = 64) -> List[bytes]:
+    """
+    Generate frames for the main interface, half of them dropped
+    by the filter. Only a few distinct frames are built and repeated.
+    """
+    case = xdp_case.XDPCase
+    passed = case.generate_default_packets(dst_port=PASS_PORT,
+                                           amount=distinct // 2)
+    dropped = case.generate_default_packets(dst_port=DROP_PORT,
+                                            amount=distinct // 2)
+    frames = [bytes(p) for pair in zip(passed, dropped) for p in pair]
+    return (frames * (amount // len(frames) + 1))[:amount]
+
+
+def measure(session, iface: str, frames: List[bytes]) -> Tuple:
+    """
+    Let the main server send the frames to the interface, return
+    the number of frames received, seconds between the first and
+    the last one and transmission statistics.
+    """
+    sniffer = capture.start_capture(iface)
+
+    fmt = wire.WireFormat.FRAMES
+    session.connect()
+    session.send((utils.ServerCommand.SEND, fmt))
+    session.send_packets(frames, fmt)
+    response = session.recv()
+    if not isinstance(response, tuple) or \
+            response[0] != utils.ServerResponse.FINISHED:
+        raise RuntimeError("Unexpected response of server", response)
+    stats = response[1]
+
+    session.send(utils.ServerCommand.STOP)
+    # All frames are sent by now, the capture ends once the last ones
+    # arrive, however many of them the filter passes.
+    received = len(utils.stop_sniffing(sniffer))
+    session.recv_packets(fmt)
+
+    return (received, sniffer.arrivals.window(), stats)
+
+
+def format_row(mode: str, counts: Dict[str, int], received: int,
+               window: float, stats) -> Tuple:
+    dropped = stats.packets - received
+    nan = float("nan")
+    return (
+        mode, counts["port"], counts["ip"], counts["ether"],
+        stats.packets, received, dropped,
+        f"{stats.seconds:.4f}", f"{window:.4f}",
+        f"{received / (window or nan):.0f}",
+        f"{dropped / (stats.seconds or nan):.0f}",
+        f"{stats.cpu_seconds * 1e9 / (stats.packets or nan):.1f}",
+    )
+
+
+def start_filter_bench(ctxs, bench_args) -> int:
+    """
+    Measure throughput of xdp-filter on the main interface,
+    for every mode and number of rules.
+    """
+    xdp_case.XDPCase = xdp_case.XDPCaseNetwork
+    xdp_case.XDPCase.set_context(ctxs)
+    xdp_case.XDPCase.prepare_class()
+
+    iface = ctxs.get_local_main().iface
+    frames = generate_traffic(bench_args["packets"])
+    rows = []
+
+    try:
+        for mode in bench_args["modes"]:
+            fd = bench.load_xdp_filter(iface, mode)
+            os.close(fd)
+            try:
+                with xdp_filter.XDPFilterMaps() as maps:
+                    for count in bench_args["rules"]:
+                        counts = fill_filter(maps, count)
+                        (received, window, stats) = measure(
+                            xdp_case.XDPCase.sessions[0], iface, frames
+                        )
+                        rows.append(format_row(mode, counts, received,
+                                               window, stats))
+            finally:
+                bench.unload_xdp_filter(iface)
+    finally:
+        xdp_case.XDPCase.sessions.close()
+
+    bench.print_table(CSV_HEADER, rows, bench_args["csv"])
+
+    return 0
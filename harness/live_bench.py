@@ -0,0 +1,87 @@
+from typing import List, Tuple
+
+from . import xdp_case, bench, packet_counter, utils, wire
+
+
+CSV_HEADER = (
+    "function", "sent", "passed", "seconds",
+    "sent/s", "passed/s", "cpu ns/packet",
+)
+
+
+def generate_traffic(distinct: int) -> List[bytes]:
+    """Generate tagged frames for the main interface, one flow each."""
+    batch = xdp_case.XDPCase.generate_template_packets(distinct)
+    batch.patch(src_port=[50000 + i % 10000 for i in range(distinct)])
+    return packet_counter.tag_packets(batch)[0]
+
+
+def measure(session, counter: packet_counter.PacketCounter,
+            frames: List[bytes], repeat: int) -> Tuple:
+    """
+    Let the main server send every frame repeat times by the kernel,
+    return the number of frames passed by the XDP program
+    and transmission statistics.
+    """
+    counter.clear()
+
+    fmt = wire.WireFormat.FRAMES
+    session.connect()
+    session.send((utils.ServerCommand.GENERATE, fmt, repeat))
+    session.send_packets(frames, fmt)
+    response = session.recv()
+    if isinstance(response, Exception):
+        raise RuntimeError("Remote side failed") from response
+    if not isinstance(response, tuple) or \
+            response[0] != utils.ServerResponse.FINISHED:
+        raise RuntimeError("Unexpected response of server", response)
+
+    captured = counter.wait_for_end()
+    if captured.overflow:
+        raise RuntimeError("Passed frames were not counted, more than "
+                           f"{packet_counter.MAX_TAGS} distinct frames "
+                           "were sent.", captured.overflow)
+    return (len(captured), response[1])
+
+
+def format_row(function: str, passed: int, stats) -> Tuple:
+    nan = float("nan")
+    seconds = stats.seconds or nan
+    return (
+        function, stats.packets, passed, f"{stats.seconds:.4f}",
+        f"{stats.packets / seconds:.0f}", f"{passed / seconds:.0f}",
+        f"{stats.cpu_seconds * 1e9 / (stats.packets or nan):.1f}",
+    )
+
+
+def start_live_bench(ctxs, live_args) -> int:
+    """
+    Measure throughput of XDP functions on the main interface, with
+    traffic generated by the kernel of the main server.
+    """
+    case = xdp_case.XDPCaseNetwork
+    xdp_case.XDPCase = case
+    case.set_context(ctxs)
+    case.prepare_class()
+
+    frames = generate_traffic(live_args["packets"])
+    counter = packet_counter.PacketCounter(ctxs.get_local_main().iface)
+    rows = []
+
+    try:
+        case.setUpClass()
+        case.load_bpf(src_file=live_args["prog"].encode(),
+                      cflags=live_args["cflags"])
+        for function in live_args["functions"]:
+            case().attach_xdp(function)
+            (passed, stats) = measure(case.sessions[0], counter,
+                                      frames, live_args["repeat"])
+            rows.append(format_row(function, passed, stats))
+    finally:
+        case.tearDownClass()
+        counter.close()
+        case.sessions.close()
+
+    bench.print_table(CSV_HEADER, rows, live_args["csv"])
+
+    return 0
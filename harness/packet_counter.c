@@ -0,0 +1,35 @@
+#include <uapi/linux/pkt_cls.h>
+
+
+struct trailer {
+	u32 magic;
+	u32 tag;
+};
+BPF_PERCPU_HASH(counts, u32, u64, MAX_TAGS);
+/* Frames whose tag did not fit into counts. */
+BPF_PERCPU_ARRAY(overflow, u64, 1);
+
+int count_tagged(struct __sk_buff *skb)
+{
+	struct trailer trailer;
+	u64 zero_value = 0;
+	int zero_key = 0;
+
+	if (skb->len < sizeof(trailer))
+		return TC_ACT_OK;
+
+	if (bpf_skb_load_bytes(skb, skb->len - sizeof(trailer),
+			       &trailer, sizeof(trailer)) < 0)
+		return TC_ACT_OK;
+
+	if (trailer.magic != TRAILER_MAGIC)
+		return TC_ACT_OK;
+
+	u64 *count = counts.lookup_or_try_init(&trailer.tag, &zero_value);
+	if (!count)
+		count = overflow.lookup(&zero_key);
+	if (count)
+		*count += 1;
+
+	return TC_ACT_OK;
+}
@@ -0,0 +1,148 @@
+import time
+import errno
+import struct
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import pyroute2
+from bcc import BPF
+
+from . import utils
+
+
+"""
+Trailer appended to frames counted by PacketCounter: magic and a tag,
+the index of the frame among distinct frames sent at once. The trailer
+lies beyond the length of the IP packet, so it is ignored like Ethernet
+padding.
+"""
+MAGIC = b"XDPT"
+TRAILER = struct.Struct("=4sI")
+
+"""
+Number of distinct tags counted at once, frames with other tags are
+only counted as overflowing.
+"""
+MAX_TAGS = 65536
+
+"""
+Handle of the classifier and the clsact qdisc's ingress parent.
+"""
+TC_HANDLE = ":1"
+TC_INGRESS = "ffff:fff2"
+
+# Period of reading counters while waiting for the end of a burst.
+POLL_PERIOD = 0.005
+
+
+def tag_packets(packets: Iterable) -> Tuple[List[bytes], Dict[bytes, int]]:
+    """
+    Return frames of packets with the trailer appended,
+    and tags of distinct frames, as they were before tagging.
+    """
+    tags: Dict[bytes, int] = {}
+    frames = []
+    for packet in packets:
+        frame = bytes(packet)
+        tag = tags.setdefault(frame, len(tags))
+        frames.append(frame + TRAILER.pack(MAGIC, tag))
+    return (frames, tags)
+
+
+class CountedCapture:
+    """
+    Numbers of tagged frames received on an interface, by their tags,
+    instead of the frames themselves. Packets are matched to tags
+    given by tag_packets, overflow counts frames without a counter.
+    """
+    def __init__(self, counts: Dict[int, int], overflow: int = 0,
+                 tags: Optional[Dict[bytes, int]] = None):
+        self.counts = counts
+        self.overflow = overflow
+        self.tags = tags or {}
+
+    def __len__(self) -> int:
+        return sum(self.counts.values()) + self.overflow
+
+    def tag_of(self, packet) -> Optional[int]:
+        return self.tags.get(bytes(packet))
+
+    def count(self, packet) -> int:
+        return self.counts.get(self.tag_of(packet), 0)
+
+    def __repr__(self):
+        return (f"<CountedCapture: {len(self)} tagged packets "
+                f"of {len(self.counts)} kinds, "
+                f"{self.overflow} overflowing>")
+
+
+class PacketCounter:
+    """
+    Counts tagged frames received on an interface by a per-CPU map,
+    using a classifier attached to the clsact qdisc's ingress.
+    Frames are counted after XDP programs let them pass.
+    """
+    def __init__(self, iface: str):
+        magic = struct.unpack("=I", MAGIC)[0]
+        self.bpf = BPF(src_file=b"harness/packet_counter.c",
+                       cflags=[f"-DTRAILER_MAGIC={magic}U",
+                               f"-DMAX_TAGS={MAX_TAGS}"])
+        func = self.bpf.load_func(b"count_tagged", BPF.SCHED_CLS)
+
+        self.ipr = pyroute2.IPRoute()
+        self.ifindex = self.ipr.link_lookup(ifname=iface)[0]
+        self.added_qdisc = True
+        try:
+            self.ipr.tc("add", "clsact", self.ifindex)
+        except pyroute2.NetlinkError as exception:
+            if exception.code != errno.EEXIST:
+                raise
+            self.added_qdisc = False
+
+        self.ipr.tc("add-filter", "bpf", self.ifindex, TC_HANDLE,
+                    fd=func.fd, name=func.name, parent=TC_INGRESS,
+                    classid=1, direct_action=True)
+
+    def close(self):
+        if self.added_qdisc:
+            self.ipr.tc("del", "clsact", self.ifindex)
+        else:
+            self.ipr.tc("del-filter", "bpf", self.ifindex, TC_HANDLE,
+                        parent=TC_INGRESS)
+        self.ipr.close()
+        self.bpf.cleanup()
+
+    def clear(self):
+        self.bpf[b"counts"].clear()
+        self.bpf[b"overflow"].clear()
+
+    def read(self) -> CountedCapture:
+        counts = {}
+        for (tag, values) in self.bpf[b"counts"].items():
+            counts[tag.value] = sum(values)
+        return CountedCapture(counts, sum(self.bpf[b"overflow"][0]))
+
+    def wait_for_end(self, expected: Optional[int] = None,
+                     idle: float = utils.BURST_IDLE_WINDOW,
+                     timeout: float = utils.BURST_TIMEOUT) -> CountedCapture:
+        """
+        Wait until the expected amount of frames is counted or, when
+        the amount is not known, until counters stop changing for the idle
+        window, and return the counters.
+        """
+        deadline = time.monotonic() + timeout
+        captured = self.read()
+        changed = time.monotonic()
+        while True:
+            now = time.monotonic()
+            if expected is not None and len(captured) >= expected:
+                return captured
+            if expected is None and now - changed >= idle:
+                return captured
+            if now >= deadline:
+                return captured
+
+            time.sleep(POLL_PERIOD)
+            previous = len(captured)
+            captured = self.read()
+            if len(captured) != previous:
+                changed = time.monotonic()
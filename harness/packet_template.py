@@ -0,0 +1,224 @@
+import ipaddress
+import dataclasses
+from typing import Iterator, Optional
+
+import numpy as np
+from scapy.all import Ether, IP, IPv6, UDP, TCP, Raw
+
+
+"""
+Payload of template frames, the sequence number of a frame is written
+over its first 4 bytes.
+"""
+TEMPLATE_PAYLOAD = b"\0\0\0\0 This is a message from a template."
+SEQUENCE_SIZE = 4
+
+IP_PROTOCOLS = {"udp": 17, "tcp": 6}
+
+
+@dataclasses.dataclass(frozen=True)
+class Layout:
+    """Offsets of fields in frames of one flow shape."""
+    layer_4: str
+    use_inet6: bool
+    l3: int
+    l4: int
+    payload: int
+    size: int
+
+    @property
+    def inet_size(self) -> int:
+        return 16 if self.use_inet6 else 4
+
+    @property
+    def inet_offset(self) -> int:
+        """Offset of the source address, followed by the destination."""
+        return self.l3 + (8 if self.use_inet6 else 12)
+
+    @property
+    def l4_checksum(self) -> int:
+        return self.l4 + (6 if self.layer_4 == "udp" else 16)
+
+    def field(self, name: str):
+        """Return the offset and the size of a field."""
+        return {
+            "dst_ether": (0, 6),
+            "src_ether": (6, 6),
+            "src_inet": (self.inet_offset, self.inet_size),
+            "dst_inet": (self.inet_offset + self.inet_size, self.inet_size),
+            "src_port": (self.l4, 2),
+            "dst_port": (self.l4 + 2, 2),
+            "seq": (self.payload, SEQUENCE_SIZE),
+        }[name]
+
+
+def build_template(src_ether: str, dst_ether: str,
+                   src_inet: str, dst_inet: str,
+                   src_port: int, dst_port: int,
+                   layer_4: str = "udp", use_inet6: bool = False):
+    """Build a template frame of a flow shape using scapy, once."""
+    if use_inet6:
+        ip_layer = IPv6(src=src_inet, dst=dst_inet)
+    else:
+        ip_layer = IP(src=src_inet, dst=dst_inet)
+
+    if layer_4 == "udp":
+        transport_layer = UDP(sport=src_port, dport=dst_port)
+    elif layer_4 == "tcp":
+        transport_layer = TCP(sport=src_port, dport=dst_port)
+    else:
+        raise ValueError("Unknown layer 4 protocol", layer_4)
+
+    template = (Ether(src=src_ether, dst=dst_ether) / ip_layer /
+                transport_layer / Raw(TEMPLATE_PAYLOAD)).build()
+
+    l3 = 14
+    l4 = l3 + (40 if use_inet6 else 20)
+    layout = Layout(layer_4, use_inet6, l3, l4,
+                    len(template) - len(TEMPLATE_PAYLOAD), len(template))
+    return (template, layout)
+
+
+def _encode(name: str, value, layout: Layout) -> bytes:
+    """Encode a value of a field to bytes in network order."""
+    if name in ("src_ether", "dst_ether"):
+        return bytes.fromhex(value.replace(":", ""))
+    if name in ("src_inet", "dst_inet"):
+        address = ipaddress.ip_address(value)
+        if address.max_prefixlen != layout.inet_size * 8:
+            raise ValueError("Address does not match the template", value)
+        return address.packed
+    return int(value).to_bytes(layout.field(name)[1], "big")
+
+
+def _is_integer_array(values) -> bool:
+    """
+    Check whether values are a NumPy array of integers, including
+    an object array of Python integers wider than NumPy's.
+    """
+    if not isinstance(values, np.ndarray):
+        return False
+    if values.dtype.kind == "O":
+        return all(isinstance(v, (int, np.integer)) for v in values)
+    return values.dtype.kind in "ui"
+
+
+def _columns(values, size: int, count: int) -> np.ndarray:
+    """Return values as a (count, size) array of bytes."""
+    if isinstance(values, np.ndarray) and values.dtype.kind in "ui" and \
+            size in (1, 2, 4, 8):
+        data = values.astype(f">u{size}").view(np.uint8).reshape(-1, size)
+    elif _is_integer_array(values):
+        # Addresses do not fit into NumPy's fixed-size integers.
+        data = np.frombuffer(
+            b"".join(int(v).to_bytes(size, "big") for v in values), np.uint8
+        ).reshape(-1, size)
+    else:
+        data = np.frombuffer(b"".join(values), np.uint8).reshape(-1, size)
+    return np.broadcast_to(data, (count, size))
+
+
+def _checksum(*parts: np.ndarray) -> np.ndarray:
+    """
+    Compute the internet checksum of every row of parts,
+    each part is an array of bytes starting at an even offset.
+    """
+    total = 0
+    for part in parts:
+        if part.shape[1] % 2:
+            part = np.pad(part, ((0, 0), (0, 1)))
+        total = total + ((part[:, 0::2].astype(np.uint64) << 8) |
+                         part[:, 1::2]).sum(axis=1)
+    while np.any(total >> 16):
+        total = (total & 0xffff) + (total >> 16)
+    return (~total & 0xffff).astype(np.uint16)
+
+
+class FrameBatch:
+    """
+    Frames of one flow shape in a single contiguous buffer, one row
+    per frame. Fields are patched in bulk and checksums are computed
+    for all frames at once.
+    """
+    def __init__(self, template: bytes, layout: Layout, count: int):
+        self.layout = layout
+        self.frames = np.tile(np.frombuffer(template, np.uint8), (count, 1))
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+    def __getitem__(self, i: int) -> memoryview:
+        return self.frames[i].data
+
+    def __iter__(self) -> Iterator[memoryview]:
+        for row in self.frames:
+            yield row.data
+
+    def patch(self, **fields):
+        """
+        Set fields of all frames, named as arguments of build_template
+        or seq for the sequence number. A value is either the same
+        for all frames or a sequence with a value per frame.
+        All fields accept NumPy arrays of integers, addresses wider
+        than 64 bits as arrays of Python integers with dtype=object.
+        """
+        for (name, values) in fields.items():
+            (offset, size) = self.layout.field(name)
+            if isinstance(values, (str, int, np.integer)):
+                values = [values]
+            if not _is_integer_array(values):
+                values = [_encode(name, v, self.layout) for v in values]
+            self.frames[:, offset:offset + size] = \
+                _columns(values, size, len(self))
+
+        self.update_checksums()
+
+    def number(self, first: int = 0):
+        """Write increasing sequence numbers into payloads."""
+        self.patch(seq=np.arange(first, first + len(self), dtype=np.uint32))
+
+    def update_checksums(self):
+        layout = self.layout
+        frames = self.frames
+
+        if not layout.use_inet6:
+            frames[:, layout.l3 + 10:layout.l3 + 12] = 0
+            checksum = _checksum(frames[:, layout.l3:layout.l4])
+            frames[:, layout.l3 + 10:layout.l3 + 12] = \
+                _columns(checksum, 2, len(self))
+
+        offset = layout.l4_checksum
+        frames[:, offset:offset + 2] = 0
+        pseudo_header = np.array(
+            [[0, IP_PROTOCOLS[layout.layer_4]],
+             list((layout.size - layout.l4).to_bytes(2, "big"))],
+            np.uint8
+        ).reshape(1, 4)
+        checksum = _checksum(
+            frames[:, layout.inet_offset:
+                   layout.inet_offset + 2 * layout.inet_size],
+            np.broadcast_to(pseudo_header, (len(self), 4)),
+            frames[:, layout.l4:],
+        )
+        if layout.layer_4 == "udp":
+            checksum[checksum == 0] = 0xffff
+        frames[:, offset:offset + 2] = _columns(checksum, 2, len(self))
+
+
+def generate(count: int, src_ether: str, dst_ether: str,
+             src_inet: str, dst_inet: str,
+             src_port: int, dst_port: int,
+             layer_4: str = "udp", use_inet6: bool = False,
+             first_seq: Optional[int] = 0) -> FrameBatch:
+    """
+    Generate count frames of a flow shape, numbered from first_seq.
+    Other fields are patched afterwards by FrameBatch.patch.
+    """
+    (template, layout) = build_template(src_ether, dst_ether,
+                                        src_inet, dst_inet,
+                                        src_port, dst_port,
+                                        layer_4, use_inet6)
+    batch = FrameBatch(template, layout, count)
+    if first_seq is not None:
+        batch.number(first_seq)
+    return batch
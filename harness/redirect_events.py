@@ -0,0 +1,100 @@
+import os
+import struct
+import threading
+import dataclasses
+from typing import Dict, Optional, Tuple
+
+from bcc import BPF
+
+from . import bpf_syscall
+
+
+"""
+Kinds of redirect events, as in enum redirect_kind.
+"""
+REDIRECT = 1
+REDIRECT_MAP = 2
+
+"""
+A test run is identified by the thread which started it, as returned
+by bpf_get_current_pid_tgid, and its sequence number in the thread.
+"""
+RunId = Tuple[int, int]
+
+
+def current_thread() -> int:
+    """Return the pid_tgid of the calling thread."""
+    return (os.getpid() << 32) | threading.get_native_id()
+
+
+def read_sequence(runs: bpf_syscall.BPFMap,
+                  pid_tgid: Optional[int] = None) -> int:
+    """Return the number of test runs started by a thread."""
+    if pid_tgid is None:
+        pid_tgid = current_thread()
+    value = runs.lookup(struct.pack("Q", pid_tgid))
+    return struct.unpack("Q", value)[0] if value is not None else 0
+
+
+@dataclasses.dataclass
+class RedirectEvent:
+    """Target of the last redirect helper called during a test run."""
+    kind: int
+    ifindex: int
+    map_type: int
+    map_name: bytes
+
+
+class RedirectProbe:
+    """
+    Tags calls of redirect helpers by the test run they were made in,
+    and passes them to userspace through a ring buffer, so targets of
+    a whole batch of test runs are read at once.
+    """
+    def __init__(self):
+        self.bpf = BPF(src_file=b"harness/bptr_probe_counter.c")
+        # Using kprobes since tracepoints do not get activated with bptr.
+        self.bpf.attach_kprobe(event=b"bpf_prog_test_run_xdp",
+                               fn_name=b"count_run")
+        self.bpf.attach_kprobe(event=b"bpf_xdp_redirect_map",
+                               fn_name=b"bpf_xdp_redirect_map")
+        self.bpf.attach_kprobe(event=b"bpf_xdp_redirect",
+                               fn_name=b"bpf_xdp_redirect")
+
+        self.runs = bpf_syscall.BPFMap(self.bpf[b"runs"].map_fd)
+        self.pending: Dict[RunId, RedirectEvent] = {}
+        self.lost = 0
+        self.bpf[b"events"].open_ring_buffer(self.__store)
+
+    def close(self):
+        self.bpf.cleanup()
+
+    def __store(self, ctx, data, size):
+        event = self.bpf[b"events"].event(data)
+        # Only the last call of a test run decides the target.
+        self.pending[(event.pid_tgid, event.seq)] = RedirectEvent(
+            event.kind, event.ifindex, event.map_type, bytes(event.map_name)
+        )
+
+    def sequence(self, pid_tgid: Optional[int] = None) -> int:
+        return read_sequence(self.runs, pid_tgid)
+
+    def drain(self):
+        """Move events from the ring buffer, keeping them until collected."""
+        self.bpf.ring_buffer_consume()
+
+    def collect(self) -> Dict[RunId, RedirectEvent]:
+        """
+        Return events of all test runs finished since the last call,
+        raise if some did not fit into the ring buffer.
+        """
+        self.drain()
+        events = self.pending
+        self.pending = {}
+
+        lost = self.bpf[b"lost"][0].value
+        if lost != self.lost:
+            self.lost = lost
+            raise RuntimeError("Redirect events were lost, "
+                               "the ring buffer is too small.")
+        return events
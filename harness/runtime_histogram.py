@@ -0,0 +1,109 @@
+import socket
+import collections
+from typing import Dict, Optional
+
+from bcc import BPF
+
+from . import utils
+
+
+"""
+Kernel functions running an XDP program on a received frame,
+with the position of the sk_buff in their arguments, by XDP mode.
+Only the first function found in the kernel is probed, the others
+are older names of the same function.
+"""
+PROBED_FUNCTIONS = {
+    utils.XDPFlag.SKB_MODE: (
+        ("bpf_prog_run_generic_xdp", 1),
+        ("netif_receive_generic_xdp", 1),
+    ),
+    utils.XDPFlag.DRV_MODE: (
+        ("veth_xdp_rcv_skb", 2),
+    ),
+}
+
+
+class RuntimeHistogram:
+    """
+    Log2 histogram of run times of an XDP program, in nanoseconds.
+    Slot k counts run times from 2^(k-1) to 2^k - 1, as bpf_log2l in bcc.
+    """
+    def __init__(self, buckets: Optional[Dict[int, int]] = None):
+        self.buckets = collections.Counter(buckets or {})
+
+    def add(self, nanoseconds: int, amount: int = 1):
+        self.buckets[int(nanoseconds).bit_length()] += amount
+
+    def update(self, other: "RuntimeHistogram"):
+        self.buckets.update(other.buckets)
+
+    @property
+    def count(self) -> int:
+        return sum(self.buckets.values())
+
+    def __bool__(self) -> bool:
+        return self.count > 0
+
+    def percentile(self, percent: float) -> int:
+        """Return the upper bound of the slot containing the percentile."""
+        threshold = self.count * percent / 100
+        seen = 0
+        for slot in sorted(self.buckets):
+            seen += self.buckets[slot]
+            if seen >= threshold:
+                return (1 << slot) - 1
+        return 0
+
+    def summary(self) -> str:
+        return (f"runtime of {self.count} packets: "
+                f"p50 <= {self.percentile(50)} ns, "
+                f"p99 <= {self.percentile(99)} ns, "
+                f"max <= {self.percentile(100)} ns")
+
+    def to_dict(self) -> Dict[int, int]:
+        return dict(sorted(self.buckets.items()))
+
+
+class RuntimeProbe:
+    """
+    Measures run times of the XDP program attached to an interface,
+    using kprobes around the kernel function running it. The measured time
+    includes the overhead of the probes and of the function itself.
+    """
+    def __init__(self, iface: str, xdp_mode: Optional[utils.XDPFlag]):
+        self.bpf = BPF(src_file=b"harness/xdp_runtime_histogram.c",
+                       cflags=[f"-DIFINDEX={socket.if_nametoindex(iface)}"])
+
+        # Without a mode, the kernel chooses it, so all modes are probed.
+        groups = [f for (mode, f) in PROBED_FUNCTIONS.items()
+                  if xdp_mode is None or xdp_mode & mode]
+        attached = False
+        for functions in groups:
+            for (function, skb_arg) in functions:
+                if not BPF.get_kprobe_functions(f"^{function}$".encode()):
+                    continue
+                self.bpf.attach_kprobe(
+                    event=function.encode(),
+                    fn_name=f"enter_skb_{skb_arg}".encode()
+                )
+                self.bpf.attach_kretprobe(event=function.encode(),
+                                          fn_name=b"leave")
+                attached = True
+                break
+
+        if not attached:
+            self.bpf.cleanup()
+            raise RuntimeError("No kernel function to probe in XDP mode",
+                               xdp_mode)
+
+    def clear(self):
+        self.bpf[b"runtime"].clear()
+
+    def read(self) -> RuntimeHistogram:
+        return RuntimeHistogram({k.value: v.value
+                                 for (k, v) in self.bpf[b"runtime"].items()
+                                 if v.value})
+
+    def close(self):
+        self.bpf.cleanup()
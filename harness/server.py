@@ -4,46 +4,122 @@ import sys
 import multiprocessing.connection
 import pickle
 import atexit
-
-from scapy.all import conf, sendp, Ether
-import bcc
-
-from . import utils
-
-
-def send_packets(iface, packets, conn):
-    packets = list(map(lambda p: Ether(bytes(p)), packets))
-    sniffer = utils.wait_for_async_sniffing(iface=iface)
-
-    sendp(packets, iface=iface)
-
-    conn.send(utils.ServerResponse.FINISHED)
-
-    assert conn.recv() == utils.ServerCommand.STOP
-    if sniffer.running:
-        sniffer.stop()
-
-    conn.send(sniffer.results)
-
-
-def watch_traffic(iface, conn):
-    sniffer = utils.wait_for_async_sniffing(iface=iface)
-    assert conn.recv() == utils.ServerCommand.STOP
-    sniffer.stop()
-    conn.send(sniffer.results)
+import threading
+
+from scapy.all import conf
+
+from . import utils, capture, transmit, wire, packet_counter
+
+
+"""
+Counters of tagged packets, created on the first use of each interface.
+"""
+counters = {}
+counters_lock = threading.Lock()
+
+
+def get_counter(iface):
+    with counters_lock:
+        if iface not in counters:
+            counters[iface] = packet_counter.PacketCounter(iface)
+            atexit.register(counters[iface].close)
+        return counters[iface]
+
+
+def start_receiving(iface, counted, writer=None):
+    """
+    Start capturing frames, streaming them by writer if given,
+    or, if counted, reset counters.
+    """
+    if counted:
+        counter = get_counter(iface)
+        counter.clear()
+        return counter
+    return capture.start_capture(iface, writer)
+
+
+def wait_for_stop(conn, receiver, counted):
+    """
+    Wait for the client to end the exchange. If the client leaves instead,
+    stop capturing before the connection is dropped.
+    """
+    try:
+        message = conn.recv()
+    except (EOFError, ConnectionResetError):
+        if not counted:
+            utils.abort_sniffing(receiver)
+        raise
+    assert message == utils.ServerCommand.STOP
+
+
+def send_received(receiver, conn, wire_format, counted, writer=None):
+    """Send captured frames or counters after the burst ends."""
+    if counted:
+        captured = receiver.wait_for_end()
+        conn.send((captured.counts, captured.overflow))
+    elif writer is not None:
+        utils.stop_sniffing(receiver)
+        writer.close()
+    else:
+        wire.send_packets(conn, utils.stop_sniffing(receiver), wire_format)
+
+
+def send_packets(iface, packets, conn, wire_format, counted=False,
+                 chunk=None):
+    frames = [bytes(p) for p in packets]
+    lock = threading.Lock()
+    writer = wire.ChunkWriter(conn, chunk, lock) if chunk else None
+    transmitter = transmit.BulkTransmitter(iface)
+    receiver = start_receiving(iface, counted, writer)
+
+    try:
+        stats = transmitter.send(frames)
+    except BaseException:
+        if not counted:
+            utils.abort_sniffing(receiver)
+        raise
+    finally:
+        transmitter.close()
+
+    with lock:
+        conn.send((utils.ServerResponse.FINISHED, stats))
+
+    wait_for_stop(conn, receiver, counted)
+    send_received(receiver, conn, wire_format, counted, writer)
+
+
+def watch_traffic(iface, conn, wire_format, counted=False, chunk=None):
+    lock = threading.Lock()
+    writer = wire.ChunkWriter(conn, chunk, lock) if chunk else None
+    receiver = start_receiving(iface, counted, writer)
+    with lock:
+        conn.send(utils.ServerResponse.STARTED)
+    wait_for_stop(conn, receiver, counted)
+    send_received(receiver, conn, wire_format, counted, writer)
+
+
+def generate_traffic(iface, packets, conn, repeat):
+    """Send packets repeat times from the kernel, using live frames."""
+    stats = transmit.LiveTransmitter(iface).send(packets, repeat)
+    conn.send((utils.ServerResponse.FINISHED, stats))
 
 
 def introduce_self(local_ctx, conn):
     conn.send(local_ctx.get_remote())
 
 
+def load_dummy_prog():
+    """
+    Load the program passing all packets, compiled only once per process,
+    so that servers forked afterwards only attach it.
+    """
+    return utils.load_verdict_prog("dummy", "XDP_PASS")
+
+
 def start_server(ctx):
     # Load xdp program to fix redirection in veth.
     if ctx.local.xdp_mode:
-        prog = bcc.BPF(
-            text=b"""int dummy(struct xdp_md *ctx) { return XDP_PASS; }"""
-        )
-        func = prog.load_func(b"dummy", bcc.BPF.XDP)
+        (prog, func) = load_dummy_prog()
         prog.attach_xdp(ctx.local.iface.encode(), func, ctx.local.xdp_mode)
 
         atexit.register(prog.remove_xdp, ctx.local.iface.encode())
@@ -52,23 +128,60 @@ def start_server(ctx):
         (ctx.comm.inet, ctx.comm.port)
     )
 
-    print(f"Server started: {ctx}.")
+    # Read by the topology manager to tell when the server is ready.
+    print(f"Server started: {ctx}.", flush=True)
     while True:
-        conn = None
-        try:
-            conn = listener.accept()
-            data = conn.recv()
-            if data[0] == utils.ServerCommand.SEND:
-                send_packets(ctx.local.iface, data[1], conn)
-            elif data[0] == utils.ServerCommand.WATCH:
-                watch_traffic(ctx.local.iface, conn)
-            elif data[0] == utils.ServerCommand.INTRODUCE:
-                introduce_self(ctx.local, conn)
-        except Exception as e:
-            conn.send(e)
-        finally:
-            if conn:
-                conn.close()
+        conn = listener.accept()
+        threading.Thread(target=serve_connection, args=(ctx, conn),
+                         daemon=True).start()
+
+
+def exchange_options(data):
+    """
+    Return options of SEND and WATCH: packets are counted instead of
+    captured if requested, or streamed in chunks of the given size.
+    """
+    counted = len(data) > 2 and bool(data[2])
+    chunk = data[3] if len(data) > 3 else None
+    return (counted, chunk)
+
+
+def serve_connection(ctx, conn):
+    """Handle commands sent over a connection until the client closes it."""
+    receiver = wire.MessageReceiver()
+    with conn:
+        while True:
+            try:
+                data = conn.recv()
+            except (EOFError, ConnectionResetError):
+                return
+
+            if not isinstance(data, tuple):
+                # Commands outside of an exchange, such as a STOP
+                # of an aborted one, are ignored.
+                continue
+
+            try:
+                if data[0] == utils.ServerCommand.SEND:
+                    (counted, chunk) = exchange_options(data)
+                    packets = wire.recv_packets(conn, receiver, data[1])
+                    send_packets(ctx.local.iface, packets, conn, data[1],
+                                 counted, chunk)
+                elif data[0] == utils.ServerCommand.WATCH:
+                    (counted, chunk) = exchange_options(data)
+                    watch_traffic(ctx.local.iface, conn, data[1],
+                                  counted, chunk)
+                elif data[0] == utils.ServerCommand.GENERATE:
+                    # Packets are sent data[2] times each by the kernel.
+                    packets = wire.recv_packets(conn, receiver, data[1])
+                    generate_traffic(ctx.local.iface, packets, conn,
+                                     data[2])
+                elif data[0] == utils.ServerCommand.INTRODUCE:
+                    introduce_self(ctx.local, conn)
+            except (EOFError, ConnectionResetError, BrokenPipeError):
+                return
+            except Exception as e:
+                conn.send(e)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,99 @@
+import time
+import multiprocessing.connection
+from typing import Dict, Iterable, List, Tuple
+
+from . import context, wire
+
+
+class ServerSession:
+    """
+    Long-lived connection to a server.
+    Commands are sent one after another over the same connection,
+    responses arrive in the order of the commands.
+    """
+    def __init__(self, comm: context.ContextCommunication):
+        self.comm = comm
+        self.conn = None
+        self.receiver = wire.MessageReceiver()
+
+    def connect(self, retry: int = 10):
+        """Open the connection, unless it is already open."""
+        if self.conn is not None:
+            return
+
+        for i in range(retry):
+            try:
+                self.conn = multiprocessing.connection.Client(
+                    (self.comm.inet, self.comm.port), "AF_INET"
+                )
+                return
+            except ConnectionRefusedError as exception:
+                if i == retry - 1:
+                    raise exception
+                time.sleep(0.2)
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def send(self, message):
+        """
+        Send a message over the open connection. A failed connection
+        is closed, so the next exchange starts over a new one.
+        """
+        if self.conn is None:
+            raise RuntimeError("Session is not connected.", self.comm)
+        try:
+            self.conn.send(message)
+        except (BrokenPipeError, ConnectionResetError, EOFError):
+            self.close()
+            raise
+
+    def recv(self):
+        try:
+            return self.conn.recv()
+        except (ConnectionResetError, EOFError):
+            self.close()
+            raise
+
+    def send_packets(self, packets, wire_format: wire.WireFormat):
+        wire.send_packets(self.conn, packets, wire_format)
+
+    def recv_packets(self, wire_format: wire.WireFormat):
+        return wire.recv_packets(self.conn, self.receiver, wire_format)
+
+    def recv_counts(self) -> Tuple[Dict[int, int], int]:
+        """
+        Receive counters of tagged packets sent by the server
+        and the number of packets which did not fit into them.
+        """
+        counts = self.recv()
+        if isinstance(counts, Exception):
+            raise RuntimeError("Remote side failed") from counts
+        return counts
+
+    def request(self, message):
+        """Send a message and wait for its response."""
+        self.connect()
+        self.send(message)
+        return self.recv()
+
+
+class SessionPool:
+    """Sessions to all servers used by a client, one per server."""
+    def __init__(self, comms: Iterable[context.ContextCommunication]):
+        self.sessions: List[ServerSession] = [ServerSession(c) for c in comms]
+
+    def __getitem__(self, i: int) -> ServerSession:
+        return self.sessions[i]
+
+    def __iter__(self):
+        return iter(self.sessions)
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+    def close(self):
+        for session in self.sessions:
+            session.close()
@@ -1,12 +1,25 @@
 
-import subprocess
-import pickle
+import os
+import sys
+import ctypes
+import traceback
 from typing import Tuple, List, Optional
 
 import pyroute2
+from scapy.all import conf
 
 from harness.context import ContextLocal, ContextCommunication, ContextServer
 from harness.utils import clean_traffic
+from harness import server
+
+
+"""
+Directory of named network namespaces, as used by iproute2 and pyroute2.
+"""
+NETNS_DIRECTORY = "/var/run/netns"
+CLONE_NEWNET = 0x40000000
+
+_libc = ctypes.CDLL(None, use_errno=True)
 
 
 def create_virtual_link(ns_a: pyroute2.IPRoute, ctx_a: ContextLocal,
@@ -34,13 +47,68 @@ def create_virtual_link(ns_a: pyroute2.IPRoute, ctx_a: ContextLocal,
         ns.link("set", index=index, state="up")
 
 
+def setns(netns: str):
+    """Move this process into a named network namespace."""
+    fd = os.open(os.path.join(NETNS_DIRECTORY, netns), os.O_RDONLY)
+    try:
+        if _libc.setns(fd, CLONE_NEWNET) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), netns)
+    finally:
+        os.close(fd)
+
+
+class ForkedServer:
+    """
+    Server forked from this process, which already imported the server's
+    modules and compiled its program, moved into its network namespace.
+    The server leads its own session, so it is not interrupted
+    together with this process.
+    """
+    def __init__(self, ctx: ContextServer, netns: Optional[str] = None,
+                 log_path: Optional[str] = None):
+        log = open(log_path, "w") if log_path is not None else None
+        # Buffered output would be written by both processes otherwise.
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.pid = os.fork()
+        if self.pid != 0:
+            if log is not None:
+                log.close()
+            return
+
+        # Never return to the caller's code in the child.
+        try:
+            os.setsid()
+            if log is not None:
+                os.dup2(log.fileno(), sys.stdout.fileno())
+                os.dup2(log.fileno(), sys.stderr.fileno())
+            if netns is not None:
+                setns(netns)
+            conf.verb = 0
+            server.start_server(ctx)
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            os._exit(1)
+
+
+def prepare_servers(to_create):
+    """Do the work shared by all servers once, before forking them."""
+    if any(sl.xdp_mode for (_, _, _, sl, _) in to_create):
+        server.load_dummy_prog()
+
+
 def create_virtual_server(
         ns_client, client_ctx_traf, client_ctx_comm,
-        ns_server, server_ctx_traf, server_ctx_comm
-) -> subprocess.Popen:
+        ns_server, server_ctx_traf, server_ctx_comm,
+        log_path: Optional[str] = None
+) -> "ForkedServer":
     """
     Create a server process in separate network namespace,
     connect it by virtual links and start it.
+    If log_path is given, the output of the server is written to the file.
     Returns the process of the created server.
     """
     server_ctx_comm_ = ContextLocal(server_ctx_traf.iface + "_comm",
@@ -55,43 +123,47 @@ def create_virtual_server(
     create_virtual_link(ns_client, client_ctx_comm_,
                         ns_server, server_ctx_comm_)
 
-    to_run = [
-        "python3", "-m", "harness.server",
-        pickle.dumps(ContextServer(
-            server_ctx_traf, server_ctx_comm,
-        ), 0).decode()
-    ]
+    return ForkedServer(ContextServer(server_ctx_traf, server_ctx_comm),
+                        getattr(ns_server, "netns", None), log_path)
 
-    if hasattr(ns_server, "netns"):
-        server_process = pyroute2.NSPopen(ns_server.netns, to_run)
-    else:
-        server_process = subprocess.Popen(to_run)
 
-    return server_process
+def server_log_path(log_dir: str, iface: str, netns_suffix: str = "") -> str:
+    return os.path.join(log_dir, f"{iface}{netns_suffix}.log")
 
 
 def create_virtual_servers_from_list(
         to_create: List[Tuple[
             ContextLocal, ContextCommunication,
             str, ContextLocal, ContextCommunication
-        ]], client_netns_name: Optional[str]
-) -> Tuple[List[subprocess.Popen], List[pyroute2.NetNS]]:
+        ]], client_netns_name: Optional[str],
+        netns_suffix: str = "",
+        log_dir: Optional[str] = None
+) -> Tuple[List[ForkedServer], List[pyroute2.NetNS]]:
     """
     Create virtual servers from contexts specified in a list.
+    Names of created network namespaces are extended by netns_suffix,
+    so that more topologies can exist at once. If log_dir is given,
+    servers log into files named by their interfaces.
     Returns a list containing processes of created servers
     and a list containing their network namespaces.
     """
     created_servers = []
     netns = {}
 
+    prepare_servers(to_create)
+
     netns[None] = pyroute2.IPRoute()
 
     for (cl, cc, sn, sl, sc) in to_create:
+        sn = sn + netns_suffix
         if sn not in netns:
             netns[sn] = pyroute2.NetNS(sn)
             clean_traffic("default", netns[sn])
+        log_path = None
+        if log_dir is not None:
+            log_path = server_log_path(log_dir, sl.iface, netns_suffix)
         new_server = create_virtual_server(netns[client_netns_name], cl, cc,
-                                           netns[sn], sl, sc)
+                                           netns[sn], sl, sc, log_path)
         created_servers.append(new_server)
 
     netns.pop(None)
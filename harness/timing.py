@@ -0,0 +1,211 @@
+import json
+import time
+import functools
+import contextlib
+import unittest
+from typing import Dict, List, Optional
+
+
+"""
+Methods of test classes timed as phases of the same name.
+"""
+TIMED_HOOKS = ("setUpClass", "tearDownClass", "setUp", "tearDown")
+
+# Record of time spent outside of any test, e.g. in loading modules.
+OUTSIDE_TESTS = "<outside of tests>"
+
+
+class PhaseRecorder:
+    """
+    Accumulates time spent in named phases of the running test,
+    or of the test class being set up or torn down. A phase started
+    inside another one is recorded as "outer/inner"; a phase started
+    inside a phase of the same name, e.g. by calling super(),
+    is counted only once.
+    """
+    def __init__(self):
+        self.records: Dict[str, Dict[str, float]] = {}
+        self.current = OUTSIDE_TESTS
+        self.stack: List[str] = []
+
+    def begin(self, key: str):
+        """Record following phases as phases of a test or class."""
+        self.current = key
+        self.stack = []
+
+    @contextlib.contextmanager
+    def scope(self, key: str):
+        """Record phases of a different test or class in the block."""
+        if key == self.current:
+            yield
+            return
+
+        (previous, stack) = (self.current, self.stack)
+        self.begin(key)
+        try:
+            yield
+        finally:
+            (self.current, self.stack) = (previous, stack)
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        if self.stack and self.stack[-1] == name:
+            yield
+            return
+
+        self.stack.append(name)
+        path = "/".join(self.stack)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stack.pop()
+            phases = self.records.setdefault(self.current, {})
+            phases[path] = phases.get(path, 0.0) + elapsed
+
+
+recorder = PhaseRecorder()
+
+
+def phase(name: str):
+    """Record time spent in the block as a phase of the running test."""
+    return recorder.phase(name)
+
+
+def timed(name: str):
+    """Decorate a function to be recorded as a phase."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with recorder.phase(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def class_key(cls) -> str:
+    return f"{cls.__module__}.{cls.__qualname__}"
+
+
+def timed_class_hook(name: str, function):
+    """Wrap a class method, recording it as a phase of its class."""
+    @functools.wraps(function)
+    def wrapper(cls, *args, **kwargs):
+        with recorder.scope(class_key(cls)), recorder.phase(name):
+            return function(cls, *args, **kwargs)
+    return wrapper
+
+
+def instrument(cls):
+    """Time unittest's hooks defined by a test class."""
+    for name in TIMED_HOOKS:
+        attribute = cls.__dict__.get(name)
+        if attribute is None:
+            continue
+
+        if isinstance(attribute, classmethod):
+            setattr(cls, name, classmethod(
+                timed_class_hook(name, attribute.__func__)
+            ))
+        else:
+            setattr(cls, name, timed(name)(attribute))
+
+
+class TimingTestResult(unittest.TextTestResult):
+    """Records total time of every test, phases are recorded by tests."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.durations: Dict[str, float] = {}
+        self.started = 0.0
+
+    def startTest(self, test):
+        recorder.begin(test.id())
+        self.started = time.perf_counter()
+        super().startTest(test)
+
+    def stopTest(self, test):
+        super().stopTest(test)
+        self.durations[test.id()] = time.perf_counter() - self.started
+        recorder.begin(OUTSIDE_TESTS)
+
+
+def build_profile(durations: Dict[str, float]) -> Dict:
+    """Combine test durations and recorded phases into a profile."""
+    totals: Dict[str, float] = {}
+    for phases in recorder.records.values():
+        for (name, seconds) in phases.items():
+            totals[name] = totals.get(name, 0.0) + seconds
+
+    return {
+        "tests": {
+            test_id: {"total": total,
+                      "phases": recorder.records.get(test_id, {})}
+            for (test_id, total) in durations.items()
+        },
+        "classes": {
+            key: {"total": sum(s for (n, s) in phases.items()
+                               if "/" not in n),
+                  "phases": phases}
+            for (key, phases) in recorder.records.items()
+            if key not in durations
+        },
+        "phases": totals,
+    }
+
+
+def merge_profiles(profiles: List[Dict]) -> Dict:
+    merged = {"tests": {}, "classes": {}, "phases": {}}
+    for profile in profiles:
+        merged["tests"].update(profile["tests"])
+        merged["classes"].update(profile["classes"])
+        for (name, seconds) in profile["phases"].items():
+            merged["phases"][name] = merged["phases"].get(name, 0.0) + seconds
+    return merged
+
+
+def print_slowest(profile: Dict, slowest: int, stream):
+    """Print the slowest tests and classes and the time of every phase."""
+    entries = list(profile["tests"].items()) + \
+        list(profile["classes"].items())
+    entries.sort(key=lambda e: e[1]["total"], reverse=True)
+
+    stream.write(f"Slowest {min(slowest, len(entries))} tests and classes:\n")
+    for (key, entry) in entries[:slowest]:
+        phases = sorted(((n, s) for (n, s) in entry["phases"].items()
+                         if "/" not in n), key=lambda p: p[1], reverse=True)
+        details = ", ".join(f"{n} {s:.3f}s" for (n, s) in phases)
+        if details:
+            details = f"  ({details})"
+        stream.write(f"  {entry['total']:8.3f}s  {key}{details}\n")
+
+    stream.write("Time per phase:\n")
+    for (name, seconds) in sorted(profile["phases"].items(),
+                                  key=lambda p: p[1], reverse=True):
+        stream.write(f"  {seconds:8.3f}s  {name}\n")
+
+
+class TimingTestRunner(unittest.TextTestRunner):
+    """
+    Runs tests recording time spent in every phase, writes the profile
+    as JSON and prints a summary of the slowest tests.
+    """
+    resultclass = TimingTestResult
+
+    def __init__(self, *args, profile: Optional[str] = None,
+                 slowest: int = 0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.profile = profile
+        self.slowest = slowest
+
+    def run(self, test):
+        result = super().run(test)
+
+        profile = build_profile(result.durations)
+        if self.profile:
+            with open(self.profile, "w") as output:
+                json.dump(profile, output, indent=1)
+        if self.slowest:
+            print_slowest(profile, self.slowest, self.stream)
+
+        return result
@@ -0,0 +1,274 @@
+import os
+import json
+import time
+import signal
+import multiprocessing.connection
+from typing import List, Optional
+
+import pyroute2
+import pyroute2.netns
+from bcc import BPF
+
+from . import utils
+from .config_virtual import virtual_ctxs
+from .setup import (create_virtual_servers_from_list, server_log_path,
+                    NETNS_DIRECTORY)
+
+
+"""
+Directory with the state of the persistent topology and logs of servers.
+"""
+STATE_DIRECTORY = "/run/xdp-test"
+
+# Printed by a server once it accepts connections.
+READY_LINE = "Server started"
+READY_TIMEOUT = 10.0
+HEALTH_TIMEOUT = 1.0
+
+
+def state_path(netns_suffix: str = "") -> str:
+    return os.path.join(STATE_DIRECTORY, f"topology{netns_suffix}.json")
+
+
+def current_netns() -> int:
+    """Return the inode of the network namespace of this process."""
+    return os.stat("/proc/self/ns/net").st_ino
+
+
+def is_server(pid: int, netns: str) -> bool:
+    """Check that a process is running in the namespace of its server."""
+    try:
+        return (os.stat(f"/proc/{pid}/ns/net").st_ino ==
+                os.stat(os.path.join(NETNS_DIRECTORY, netns)).st_ino)
+    except OSError:
+        return False
+
+
+def processes_in(netns: str) -> List[int]:
+    """Return processes running in a named network namespace."""
+    try:
+        inode = os.stat(os.path.join(NETNS_DIRECTORY, netns)).st_ino
+    except OSError:
+        return []
+
+    pids = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit() or int(entry) == os.getpid():
+            continue
+        try:
+            if os.stat(f"/proc/{entry}/ns/net").st_ino == inode:
+                pids.append(int(entry))
+        except OSError:
+            pass
+    return pids
+
+
+def terminate(pid: int):
+    """
+    Terminate a server with processes it started. Servers started
+    by older versions do not lead their own process group.
+    """
+    try:
+        os.killpg(pid, signal.SIGTERM)
+    except ProcessLookupError:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+
+class Topology:
+    """
+    Network namespaces, virtual links and servers built from
+    config_virtual. A persistent topology outlives the process which
+    built it and is reused by later runs, as long as it is healthy.
+    """
+    def __init__(self, netns: List[str], pids: List[int],
+                 server_netns: List[str], logs: List[str],
+                 client_netns: int, sysctls: List[str],
+                 netns_suffix: str = ""):
+        self.netns = netns
+        self.pids = pids
+        self.server_netns = server_netns
+        self.logs = logs
+        self.client_netns = client_netns
+        # Settings of the client's namespace, restored by destroy.
+        self.sysctls = sysctls
+        self.netns_suffix = netns_suffix
+
+    @classmethod
+    def build(cls, ctxs, netns_suffix: str = "",
+              persistent: bool = False) -> "Topology":
+        """Build the topology and wait until all servers are ready."""
+        os.makedirs(STATE_DIRECTORY, exist_ok=True)
+        restore = not persistent
+        sysctls = utils.clean_traffic("default", restore_on_exit=restore)
+
+        (servers, netns) = create_virtual_servers_from_list(
+            virtual_ctxs, None, netns_suffix, STATE_DIRECTORY
+        )
+        names = [ns.netns for ns in netns]
+        for ns in netns:
+            ns.close()
+
+        topology = cls(
+            names, [s.pid for s in servers],
+            [sn + netns_suffix for (_, _, sn, _, _) in virtual_ctxs],
+            [server_log_path(STATE_DIRECTORY, sl.iface, netns_suffix)
+             for (_, _, _, sl, _) in virtual_ctxs],
+            current_netns(), [s.decode() for s in sysctls], netns_suffix
+        )
+        try:
+            for i in range(ctxs.server_count()):
+                utils.clean_traffic(ctxs.get_local(i).iface,
+                                    restore_on_exit=restore)
+            topology.wait_ready()
+        except BaseException:
+            topology.destroy()
+            raise
+
+        if persistent:
+            topology.save()
+        return topology
+
+    @classmethod
+    def load(cls, netns_suffix: str = "") -> Optional["Topology"]:
+        """
+        Return the persistent topology, if there is one. A state written
+        by another version of the harness is destroyed instead.
+        """
+        try:
+            with open(state_path(netns_suffix)) as state:
+                fields = json.load(state)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            fields = {}
+
+        try:
+            return cls(**fields)
+        except TypeError:
+            cls.destroy_stale(fields, netns_suffix)
+            return None
+
+    @classmethod
+    def destroy_stale(cls, fields, netns_suffix: str = ""):
+        """
+        Remove namespaces named in an unreadable state, with servers
+        found running in them, and the state itself.
+        """
+        names = fields.get("netns") if isinstance(fields, dict) else None
+        if not isinstance(names, list):
+            names = []
+        names = [n for n in names if isinstance(n, str)]
+
+        stale = cls(names, [], [], [], current_netns(), [], netns_suffix)
+        for name in names:
+            for pid in processes_in(name):
+                stale.pids.append(pid)
+                stale.server_netns.append(name)
+        stale.stop()
+
+        try:
+            os.unlink(state_path(netns_suffix))
+        except FileNotFoundError:
+            pass
+
+    def save(self):
+        with open(state_path(self.netns_suffix), "w") as state:
+            json.dump(self.__dict__, state)
+
+    def wait_ready(self, timeout: float = READY_TIMEOUT):
+        """Wait until every server reports it accepts connections."""
+        deadline = time.monotonic() + timeout
+        waiting = list(zip(self.pids, self.server_netns, self.logs))
+        while waiting:
+            (pid, netns, log) = waiting[0]
+            with open(log) as output:
+                if READY_LINE in output.read():
+                    waiting.pop(0)
+                    continue
+            if not is_server(pid, netns):
+                raise RuntimeError("Server exited before being ready, "
+                                   "see its log.", log)
+            if time.monotonic() >= deadline:
+                raise RuntimeError("Server is not ready, see its log.", log)
+            time.sleep(0.01)
+
+    def alive(self) -> bool:
+        return (self.client_netns == current_netns() and
+                all(map(is_server, self.pids, self.server_netns)))
+
+    def healthy(self, ctxs) -> bool:
+        """Check that every server is running and answers quickly."""
+        if not self.alive():
+            return False
+
+        for comm in ctxs.comms:
+            try:
+                with multiprocessing.connection.Client(
+                        (comm.inet, comm.port), "AF_INET") as conn:
+                    conn.send((utils.ServerCommand.INTRODUCE, ))
+                    if not conn.poll(HEALTH_TIMEOUT):
+                        return False
+                    conn.recv()
+            except (OSError, EOFError):
+                return False
+        return True
+
+    def detach_programs(self, ctxs):
+        """
+        Detach XDP programs and packet counters left on the client's
+        interfaces by a run which did not finish, before the topology
+        is reused.
+        """
+        with pyroute2.IPRoute() as ipr:
+            for i in range(ctxs.server_count()):
+                iface = ctxs.get_local(i).iface
+                for mode in (utils.XDPFlag.SKB_MODE, utils.XDPFlag.DRV_MODE):
+                    try:
+                        BPF.remove_xdp(iface.encode(), mode)
+                    except Exception:
+                        # Nothing is attached in this mode.
+                        pass
+
+                # Classifiers of PacketCounter are removed with the qdisc.
+                try:
+                    ipr.tc("del", "clsact", ipr.link_lookup(ifname=iface)[0])
+                except pyroute2.NetlinkError:
+                    pass
+
+    def stop(self):
+        """Stop servers and remove namespaces with their links."""
+        for (pid, netns) in zip(self.pids, self.server_netns):
+            if is_server(pid, netns):
+                terminate(pid)
+
+        deadline = time.monotonic() + READY_TIMEOUT
+        while any(map(is_server, self.pids, self.server_netns)) and \
+                time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        # Servers forked by this process are reaped here.
+        for pid in self.pids:
+            try:
+                os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                pass
+
+        for name in self.netns:
+            try:
+                pyroute2.netns.remove(name)
+            except OSError:
+                pass
+
+        utils.restore_traffic([s.encode() for s in self.sysctls])
+
+    def destroy(self):
+        """Stop the topology and forget its state."""
+        self.stop()
+
+        # The state belongs to another topology if this one is not saved.
+        saved = Topology.load(self.netns_suffix)
+        if saved is not None and saved.pids == self.pids:
+            os.unlink(state_path(self.netns_suffix))
@@ -0,0 +1,176 @@
+import os
+import time
+import errno
+import ctypes
+import socket
+import dataclasses
+from typing import Sequence
+
+from bcc import BPF
+
+from . import bpf_syscall, utils
+
+
+class IOVec(ctypes.Structure):
+    _fields_ = [
+        ("iov_base", ctypes.c_void_p),
+        ("iov_len", ctypes.c_size_t),
+    ]
+
+
+class MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(IOVec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class MMsgHdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_hdr", MsgHdr),
+        ("msg_len", ctypes.c_uint),
+    ]
+
+
+def cpu_busy_seconds() -> float:
+    """Return time all CPUs spent doing any work, from /proc/stat."""
+    with open("/proc/stat") as stat:
+        fields = stat.readline().split()[1:]
+    # user, nice, system, idle, iowait, irq, softirq, steal
+    ticks = [int(f) for f in fields[:8]]
+    busy = sum(ticks) - ticks[3] - ticks[4]
+    return busy / os.sysconf("SC_CLK_TCK")
+
+
+@dataclasses.dataclass
+class TransmitStats:
+    """
+    Amount of transmitted frames and the time it took. CPU time is spent
+    by the whole system during the transmission, which includes processing
+    of the frames by the receiving side of a veth pair.
+    """
+    packets: int = 0
+    bytes: int = 0
+    seconds: float = 0.0
+    cpu_seconds: float = 0.0
+
+    @property
+    def packets_per_second(self) -> float:
+        if self.seconds == 0:
+            return float("inf")
+        return self.packets / self.seconds
+
+
+def _frame_address(frame) -> int:
+    if isinstance(frame, bytes):
+        return ctypes.cast(ctypes.c_char_p(frame), ctypes.c_void_p).value
+    return ctypes.addressof((ctypes.c_char * len(frame)).from_buffer(frame))
+
+
+class BulkTransmitter:
+    """
+    Sends pre-serialized frames out of an interface,
+    in batches of up to batch_size frames per sendmmsg call.
+    """
+    def __init__(self, iface: str, batch_size: int = 256):
+        self.batch_size = batch_size
+        self.sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, 0)
+        self.sock.bind((iface, 0))
+
+        libc = ctypes.CDLL(None, use_errno=True)
+        self.sendmmsg = getattr(libc, "sendmmsg", None)
+        if self.sendmmsg is not None:
+            self.sendmmsg.argtypes = [
+                ctypes.c_int, ctypes.POINTER(MMsgHdr),
+                ctypes.c_uint, ctypes.c_int,
+            ]
+            self.sendmmsg.restype = ctypes.c_int
+
+        self.iovecs = (IOVec * batch_size)()
+        self.msgs = (MMsgHdr * batch_size)()
+        for i in range(batch_size):
+            self.msgs[i].msg_hdr.msg_iov = ctypes.pointer(self.iovecs[i])
+            self.msgs[i].msg_hdr.msg_iovlen = 1
+
+    def close(self):
+        self.sock.close()
+
+    def send(self, frames: Sequence) -> TransmitStats:
+        """Send all frames, return statistics of the transmission."""
+        frames = [f if isinstance(f, (bytes, bytearray)) or
+                  (isinstance(f, memoryview) and not f.readonly)
+                  else bytes(f) for f in frames]
+
+        cpu_start = cpu_busy_seconds()
+        start = time.perf_counter()
+        if self.sendmmsg is None:
+            for frame in frames:
+                self.sock.send(frame)
+        else:
+            for first in range(0, len(frames), self.batch_size):
+                self.__send_batch(frames[first:first + self.batch_size])
+        seconds = time.perf_counter() - start
+        cpu_seconds = cpu_busy_seconds() - cpu_start
+
+        return TransmitStats(len(frames), sum(map(len, frames)),
+                             seconds, cpu_seconds)
+
+    def __send_batch(self, batch):
+        for (i, frame) in enumerate(batch):
+            self.iovecs[i].iov_base = _frame_address(frame)
+            self.iovecs[i].iov_len = len(frame)
+
+        sent = 0
+        while sent < len(batch):
+            res = self.sendmmsg(self.sock.fileno(),
+                                ctypes.byref(self.msgs[sent]),
+                                len(batch) - sent, 0)
+            if res < 0:
+                err = ctypes.get_errno()
+                if err in (errno.ENOBUFS, errno.EAGAIN, errno.EINTR):
+                    os.sched_yield()
+                    continue
+                raise OSError(err, os.strerror(err))
+            sent += res
+
+
+class LiveTransmitter:
+    """
+    Sends frames out of an interface by the kernel, running a program
+    returning XDP_TX over them using BPF_PROG_TEST_RUN command
+    with live frames, without a userspace send loop.
+    """
+    def __init__(self, iface: str, batch_size: int = 0):
+        self.ifindex = socket.if_nametoindex(iface)
+        self.batch_size = batch_size
+        (_, func) = utils.load_verdict_prog("tx_all", "XDP_TX")
+        self.fd = func.fd
+
+    def send(self, frames: Sequence, repeat: int = 1) -> TransmitStats:
+        """Send every frame repeat times, return statistics."""
+        frames = [bytes(f) for f in frames]
+
+        cpu_start = cpu_busy_seconds()
+        start = time.perf_counter()
+        for frame in frames:
+            try:
+                bpf_syscall.prog_test_run_live(self.fd, frame, repeat,
+                                               self.ifindex, self.batch_size)
+            except OSError as exception:
+                if exception.errno == errno.EINVAL:
+                    raise RuntimeError(
+                        "Live frames are not supported by the kernel "
+                        "or the frame does not fit into a page.", len(frame)
+                    ) from exception
+                raise
+        seconds = time.perf_counter() - start
+        cpu_seconds = cpu_busy_seconds() - cpu_start
+
+        return TransmitStats(len(frames) * repeat,
+                             sum(map(len, frames)) * repeat,
+                             seconds, cpu_seconds)
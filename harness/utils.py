@@ -2,9 +2,13 @@ import enum
 import subprocess
 import atexit
 import threading
+import time
+import functools
+from typing import Optional
 
 from scapy.all import AsyncSniffer, L2ListenSocket
 import pyroute2
+from bcc import BPF
 
 
 class XDPFlag(enum.IntFlag):
@@ -32,11 +36,13 @@ class ServerCommand(enum.Enum):
 
     SEND = enum.auto()
     WATCH = enum.auto()
+    GENERATE = enum.auto()
 
     STOP = enum.auto()
 
 
 class ServerResponse(enum.Enum):
+    STARTED = enum.auto()
     FINISHED = enum.auto()
     TIMEOUT = enum.auto()
 
@@ -52,6 +58,11 @@ def restore_traffic(sysctl_state):
 def clean_traffic(iface: str,
                   netns: pyroute2.NetNS = None,
                   restore_on_exit: bool = True):
+    """
+    Disable IPv6 traffic generated by the kernel on an interface.
+    Return previous settings outside of a namespace, as accepted
+    by restore_traffic.
+    """
     sysctl_state = []
     MILLISECONDS_IN_HOUR = 1000 * 60 * 60
 
@@ -85,7 +96,9 @@ def clean_traffic(iface: str,
                 iface + "." + setting + "=" + str(value)
             ], capture_output=True)
 
-    atexit.register(restore_traffic, sysctl_state)
+    if restore_on_exit:
+        atexit.register(restore_traffic, sysctl_state)
+    return sysctl_state
 
 
 class L2ListenSocketOutgoing(L2ListenSocket):
@@ -99,10 +112,104 @@ class L2ListenSocketOutgoing(L2ListenSocket):
         self.ins.setsockopt(SOL_PACKET, PACKET_IGNORE_OUTGOING, 1)
 
 
+"""
+Time without any captured frame after which a burst is considered finished,
+and the longest time to wait for a burst to finish, in seconds.
+"""
+BURST_IDLE_WINDOW = 0.05
+BURST_TIMEOUT = 5.0
+
+
+class ArrivalTracker:
+    """
+    Counts frames arriving to a capture,
+    so that the capture can be stopped as soon as a burst ends.
+    """
+    def __init__(self):
+        self.count = 0
+        self.first_arrival: Optional[float] = None
+        self.last_arrival = time.monotonic()
+        self.condition = threading.Condition()
+
+    def __call__(self, _frame=None, amount: int = 1):
+        with self.condition:
+            self.count += amount
+            self.last_arrival = time.monotonic()
+            if self.first_arrival is None:
+                self.first_arrival = self.last_arrival
+            self.condition.notify_all()
+
+    def window(self) -> float:
+        """Return seconds between the first and the last arrival."""
+        with self.condition:
+            if self.first_arrival is None:
+                return 0.0
+            return self.last_arrival - self.first_arrival
+
+    def wait_for_end(self, idle: float = BURST_IDLE_WINDOW,
+                     timeout: float = BURST_TIMEOUT) -> bool:
+        """
+        Wait until no frame arrives for the idle window. The number
+        of frames of a burst is not known in advance, since the XDP
+        program decides which of them arrive.
+        Returns False if frames kept arriving until the timeout.
+        """
+        start = time.monotonic()
+        deadline = start + timeout
+
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                quiet_since = max(self.last_arrival, start)
+                if now - quiet_since >= idle:
+                    return True
+                if now >= deadline:
+                    return False
+                self.condition.wait(min(quiet_since + idle, deadline) - now)
+
+
+def stop_sniffing(sniffer):
+    """
+    Stop a sniffer started by wait_for_async_sniffing
+    once the burst it captures has ended, return its results.
+    Raises if the burst did not end in time, instead of returning
+    a truncated capture.
+    """
+    ended = sniffer.arrivals.wait_for_end()
+    if sniffer.running:
+        sniffer.stop()
+
+    if not ended:
+        raise RuntimeError("Frames kept arriving, the capture did not end "
+                           "in time.", BURST_TIMEOUT)
+    return sniffer.results
+
+
+def abort_sniffing(sniffer):
+    """Stop a sniffer without waiting for the end of its burst."""
+    if sniffer is not None and sniffer.running:
+        sniffer.stop()
+
+
 def wait_for_async_sniffing(*args, **kwargs):
-    """Starts AsyncSniffer and waits until it starts sniffing."""
+    """
+    Starts AsyncSniffer and waits until it starts sniffing.
+    Arrivals of frames are tracked in the arrivals attribute.
+    """
 
     lock = threading.Lock()
+    arrivals = ArrivalTracker()
+
+    if "prn" in kwargs:
+        original_prn = kwargs["prn"]
+
+        def combined_prn(packet):
+            arrivals(packet)
+            return original_prn(packet)
+    else:
+        combined_prn = arrivals
+
+    kwargs["prn"] = combined_prn
 
     if "started_callback" in kwargs:
         original_started_callback = kwargs["started_callback"]
@@ -117,7 +224,20 @@ def wait_for_async_sniffing(*args, **kwargs):
     kwargs["L2socket"] = L2ListenSocketOutgoing
     lock.acquire()
     asniff = AsyncSniffer(*args, **kwargs)
+    asniff.arrivals = arrivals
     asniff.start()
     lock.acquire()
 
     return asniff
+
+
+@functools.lru_cache(maxsize=None)
+def load_verdict_prog(name: str, verdict: str):
+    """
+    Compile an XDP function returning a fixed verdict, only once per process.
+    The program has no maps, so sharing it does not share any state.
+    Returns the program and the loaded function.
+    """
+    prog = BPF(text=f"int {name}(struct xdp_md *ctx) {{ return {verdict}; }}"
+               .encode())
+    return (prog, prog.load_func(name.encode(), BPF.XDP))
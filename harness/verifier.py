@@ -0,0 +1,78 @@
+import abc
+import collections
+from typing import Callable, Iterable, List, Optional
+
+
+"""
+Interface of frames captured by the client,
+other interfaces are numbered as servers in ContextClientList.
+"""
+LOCAL = None
+
+
+class StreamVerifier(abc.ABC):
+    """
+    Consumes frames captured while streaming, chunk by chunk,
+    keeping only what is needed to verify them.
+    """
+    @abc.abstractmethod
+    def feed(self, interface: Optional[int], frames: List[bytes]):
+        """Consume a chunk of frames captured on an interface."""
+
+    def failure(self) -> Optional[str]:
+        """Return a description of a failed verification, if any."""
+        return None
+
+
+class ExpectedSetVerifier(StreamVerifier):
+    """
+    Checks that every expected packet arrives to the interface, each
+    occurrence matching a different frame, and that nothing else
+    arrives anywhere. Memory is bounded by the expected packets.
+    """
+    def __init__(self, expected: Iterable, interface: Optional[int] = LOCAL):
+        self.interface = interface
+        self.remaining = collections.Counter(map(bytes, expected))
+        self.unexpected = collections.Counter()
+
+    def feed(self, interface, frames):
+        for frame in frames:
+            key = bytes(frame)
+            if interface == self.interface and self.remaining[key] > 0:
+                self.remaining[key] -= 1
+            else:
+                self.unexpected[interface] += 1
+
+    @property
+    def missing(self) -> int:
+        return sum(self.remaining.values())
+
+    def failure(self):
+        if self.missing:
+            return (f"{self.missing} expected packets did not arrive "
+                    f"to interface {self.interface}.")
+        if self.unexpected:
+            return (f"Unexpected packets arrived, by interface: "
+                    f"{dict(self.unexpected)}.")
+        return None
+
+
+class CountingVerifier(StreamVerifier):
+    """Counts frames and bytes arriving to every interface."""
+    def __init__(self):
+        self.packets = collections.Counter()
+        self.bytes = collections.Counter()
+
+    def feed(self, interface, frames):
+        self.packets[interface] += len(frames)
+        self.bytes[interface] += sum(map(len, frames))
+
+
+class CallbackVerifier(StreamVerifier):
+    """Passes every chunk to a callback, which may raise on failure."""
+    def __init__(self, callback: Callable[[Optional[int], List[bytes]],
+                                          None]):
+        self.callback = callback
+
+    def feed(self, interface, frames):
+        self.callback(interface, frames)
@@ -0,0 +1,143 @@
+import enum
+import pickle
+import struct
+import threading
+import multiprocessing
+from typing import List, Sequence, Tuple
+
+
+"""
+Header of a message carrying raw frames: magic, version, flags, frame count.
+Each frame follows, prefixed by its length.
+"""
+MAGIC = b"XDPF"
+VERSION = 2
+HEADER = struct.Struct("!4sBBxxI")
+# Captured frames may exceed 64 KiB, e.g. with GRO or GSO.
+LENGTH = struct.Struct("!I")
+
+
+class FrameFlag(enum.IntFlag):
+    NONE = 0
+    # Last message of a stream of frames.
+    END = (1 << 0)
+
+
+class WireFormat(enum.Enum):
+    """Encoding of packets sent between a client and a server."""
+    PICKLE = enum.auto()
+    FRAMES = enum.auto()
+
+
+def pack_frames(frames: Sequence, flags: FrameFlag = FrameFlag.NONE) -> bytes:
+    """Encode frames into a message."""
+    parts = [HEADER.pack(MAGIC, VERSION, flags, len(frames))]
+    for frame in frames:
+        parts.append(LENGTH.pack(len(frame)))
+        parts.append(frame)
+    return b"".join(parts)
+
+
+def is_frames(message) -> bool:
+    return bytes(message[:len(MAGIC)]) == MAGIC
+
+
+def unpack_frames(message) -> Tuple[FrameFlag, List[bytes]]:
+    """Decode a message created by pack_frames."""
+    message = memoryview(message)
+    (magic, version, flags, count) = HEADER.unpack_from(message)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a message with frames", magic, version)
+
+    frames = []
+    offset = HEADER.size
+    for _ in range(count):
+        (length, ) = LENGTH.unpack_from(message, offset)
+        offset += LENGTH.size
+        frames.append(bytes(message[offset:offset + length]))
+        offset += length
+
+    return (FrameFlag(flags), frames)
+
+
+def send_frames(conn, frames: Sequence,
+                flags: FrameFlag = FrameFlag.NONE):
+    conn.send_bytes(pack_frames(frames, flags))
+
+
+class ChunkWriter:
+    """
+    Sends frames over a connection in messages of up to chunk frames,
+    as they are passed to it. Sends on the connection are serialized
+    by the lock, shared with other senders.
+    """
+    def __init__(self, conn, chunk: int, lock: threading.Lock):
+        self.conn = conn
+        self.chunk = chunk
+        self.lock = lock
+        self.buffer: List[bytes] = []
+
+    def __call__(self, frames: Sequence):
+        with self.lock:
+            self.buffer.extend(frames)
+            while len(self.buffer) >= self.chunk:
+                send_frames(self.conn, self.buffer[:self.chunk])
+                del self.buffer[:self.chunk]
+
+    def close(self):
+        """Send the remaining frames, marking the end of the stream."""
+        with self.lock:
+            send_frames(self.conn, self.buffer, FrameFlag.END)
+            self.buffer = []
+
+
+class MessageReceiver:
+    """
+    Receives messages from a connection into a reusable buffer,
+    growing it when a message does not fit.
+    """
+    def __init__(self, size: int = 1 << 20):
+        self.buffer = bytearray(size)
+
+    def recv_bytes(self, conn) -> memoryview:
+        try:
+            size = conn.recv_bytes_into(self.buffer)
+            return memoryview(self.buffer)[:size]
+        except multiprocessing.BufferTooShort as exception:
+            message = exception.args[0]
+            self.buffer = bytearray(len(message) * 2)
+            return memoryview(message)
+
+    def recv(self, conn):
+        """
+        Receive a message, either frames as (flags, frames),
+        or a pickled object.
+        """
+        message = self.recv_bytes(conn)
+        if is_frames(message):
+            return unpack_frames(message)
+        return pickle.loads(message)
+
+    def recv_frames(self, conn) -> Tuple[FrameFlag, List[bytes]]:
+        message = self.recv(conn)
+        if isinstance(message, Exception):
+            raise RuntimeError("Remote side failed") from message
+        if not isinstance(message, tuple):
+            raise ValueError("Expected frames, received", message)
+        return message
+
+
+def send_packets(conn, packets: Sequence, wire_format: WireFormat):
+    """Send packets, encoded as frames or pickled."""
+    if wire_format == WireFormat.FRAMES:
+        send_frames(conn, [bytes(p) for p in packets])
+    else:
+        conn.send(list(packets))
+
+
+def recv_packets(conn, receiver: MessageReceiver,
+                 wire_format: WireFormat) -> List:
+    """Receive packets sent by send_packets."""
+    if wire_format == WireFormat.FRAMES:
+        return receiver.recv_frames(conn)[1]
+    return conn.recv()
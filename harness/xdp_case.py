@@ -1,14 +1,20 @@
-import time
+import atexit
 import ctypes
-import multiprocessing.connection
 import errno
+import threading
+import functools
+import collections
+import multiprocessing.connection
 from typing import List, Iterable, Optional
 import unittest
 
 from scapy.all import Ether, Packet, IP, IPv6, Ether, Raw, UDP, TCP
 from bcc import BPF
 
-from . import utils, context
+from . import (utils, context, bpf_cache, session,
+               capture, transmit, wire, runtime_histogram, timing,
+               packet_counter, verifier, bptr_pool,
+               redirect_events, bpf_syscall)
 
 
 def usingCustomLoader(test):
@@ -21,63 +27,103 @@ def usingCustomLoader(test):
 
 
 class SendResult:
+    """
+    Packets captured on each interface, either as scapy packets
+    or as raw frames, and statistics of sending them if available.
+    """
     def __init__(self, captured_local: List[Packet],
-                 captured_remote: List[List[Packet]]):
+                 captured_remote: List[List[Packet]],
+                 tx_stats: Optional[transmit.TransmitStats] = None):
         self.captured_local = captured_local
         self.captured_remote = captured_remote
+        self.tx_stats = tx_stats
 
 
-def _prog_test_run(fd, pkt):
-    lib = ctypes.CDLL("libbcc.so.0", use_errno=True)
-    lib.bpf_prog_test_run.argtype = [
-        ctypes.c_int, ctypes.c_int,
-        ctypes.c_void_p, ctypes.c_uint32,
-        ctypes.c_void_p, ctypes.c_uint32,
-        ctypes.c_uint32, ctypes.c_uint32,
-    ]
-    lib.bpf_prog_test_run.restype = ctypes.c_int
-
+class BPTRRunner:
     """
-    LIBBPF_API int bpf_prog_test_run(
-        int prog_fd, int repeat,
-        void *data, __u32 size,
-        void *data_out, __u32 *size_out,
-        __u32 *retval, __u32 *duration
-    );
+    Runs packets through an XDP program using BPF_PROG_TEST_RUN command.
+    The library handle and buffers are reused between runs.
     """
 
     # Maximum size of ether frame size is 1522B.
-    out_size = ctypes.c_int(2048)
-    out = ctypes.create_string_buffer(out_size.value)
-    ret = ctypes.c_int()
-    dur = ctypes.c_int()
-    pkt = bytes(pkt)
+    BUFFER_SIZE = 2048
 
-    res = lib.bpf_prog_test_run(
-        fd, 1,
-        pkt, len(pkt),
-        ctypes.byref(out), ctypes.byref(out_size),
-        ctypes.byref(ret), ctypes.byref(dur)
-    )
+    def __init__(self, buffer_size: int = BUFFER_SIZE):
+        self.lib = ctypes.CDLL("libbcc.so.0", use_errno=True)
 
-    if res != 0:
-        raise RuntimeError("bpf_prog_test_run failed, returned", res,
-                           "because", errno.errorcode[ctypes.get_errno()])
+        """
+        LIBBPF_API int bpf_prog_test_run(
+            int prog_fd, int repeat,
+            void *data, __u32 size,
+            void *data_out, __u32 *size_out,
+            __u32 *retval, __u32 *duration
+        );
+        """
+        self.lib.bpf_prog_test_run.argtypes = [
+            ctypes.c_int, ctypes.c_int,
+            ctypes.c_void_p, ctypes.c_uint32,
+            ctypes.c_void_p, ctypes.POINTER(ctypes.c_uint32),
+            ctypes.POINTER(ctypes.c_uint32), ctypes.POINTER(ctypes.c_uint32),
+        ]
+        self.lib.bpf_prog_test_run.restype = ctypes.c_int
+
+        self.buffer_size = buffer_size
+        self.data_in = ctypes.create_string_buffer(buffer_size)
+        self.data_out = ctypes.create_string_buffer(buffer_size)
+        self.view_in = memoryview(self.data_in).cast("B")
+        self.view_out = memoryview(self.data_out).cast("B")
+
+        self.size_out = ctypes.c_uint32()
+        self.retval = ctypes.c_uint32()
+        self.duration = ctypes.c_uint32()
+        self.size_out_ref = ctypes.byref(self.size_out)
+        self.retval_ref = ctypes.byref(self.retval)
+        self.duration_ref = ctypes.byref(self.duration)
+
+    def run(self, fd: int, data, repeat: int = 1):
+        """
+        Run data through the program.
+        Returns the return value of the program, the output and the average
+        duration of a repetition in nanoseconds. The output is a memoryview
+        of the runner's buffer, valid only until the next run.
+        """
+        if not isinstance(data, (bytes, bytearray, memoryview)):
+            data = bytes(data)
+
+        size = len(data)
+        if size > self.buffer_size:
+            raise ValueError("Packet does not fit into the buffer", size)
+        self.view_in[:size] = data
+        self.size_out.value = self.buffer_size
+
+        res = self.lib.bpf_prog_test_run(
+            fd, repeat,
+            self.data_in, size,
+            self.data_out, self.size_out_ref,
+            self.retval_ref, self.duration_ref
+        )
 
-    out = bytes(out[:out_size.value])
-    pkt_out = Ether(out)
+        if res != 0:
+            raise RuntimeError("bpf_prog_test_run failed, returned", res,
+                               "because", errno.errorcode[ctypes.get_errno()])
 
-    return (ret.value, pkt_out)
+        return (self.retval.value,
+                self.view_out[:self.size_out.value],
+                self.duration.value)
 
 
 def _describe_packet(packet):
-    if hasattr(packet, "summary"):
-        return f"{packet.summary()} ({bytes(packet)})"
+    if isinstance(packet, (bytes, bytearray, memoryview)):
+        # Raw frames are decoded only when describing a failure.
+        packet = Ether(bytes(packet))
 
-    return f"{bytes(packet)}"
+    return f"{packet.summary()} ({bytes(packet)})"
 
 
 def _describe_packet_container(container: scapy.plist.PacketList):
+    if isinstance(container, packet_counter.CountedCapture):
+        return str(container)
+
     if len(container) == 0:
         return "[]"
 
@@ -90,7 +136,47 @@ def _describe_packet_container(container: scapy.plist.PacketList):
     return str(container)
 
 
+class PacketIndex:
+    """
+    Multiset of packets in a container, indexed by their bytes,
+    so that membership is checked in constant time.
+    Counted captures are indexed by tags of packets instead.
+    """
+    def __init__(self, container: Iterable[Packet]):
+        if isinstance(container, packet_counter.CountedCapture):
+            self.key = container.tag_of
+            self.counts = collections.Counter(container.counts)
+        else:
+            self.key = bytes
+            self.counts = collections.Counter(map(bytes, container))
+
+    def __contains__(self, packet) -> bool:
+        return self.counts.get(self.key(packet), 0) > 0
+
+    def consume(self, packet) -> bool:
+        """Remove one occurrence of packet, return whether there was one."""
+        key = self.key(packet)
+        if self.counts.get(key, 0) == 0:
+            return False
+        self.counts[key] -= 1
+        return True
+
+
 class XDPCase(unittest.TestCase):
+    # Whether to measure run times of the XDP program, set by the client.
+    measure_runtime = False
+    # Run times of the XDP program while processing packets of a test.
+    xdp_runtime: Optional[runtime_histogram.RuntimeHistogram] = None
+    # Whether to count packets instead of capturing them, set by the client.
+    use_counters = False
+    # Whether tests of the class only check packets not modified
+    # by the XDP program, which is required for counting them.
+    supports_counters = False
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        timing.instrument(cls)
+
     @classmethod
     def set_context(cls, ctxs: context.ContextClientList):
         """Set ContextClientList to be used for testing."""
@@ -120,57 +206,91 @@ class XDPCase(unittest.TestCase):
         """Process packets by selected XDP function."""
         raise NotImplementedError
 
+    def stream_packets(self, packets: Iterable[Packet],
+                       stream_verifier: verifier.StreamVerifier,
+                       chunk: int = 1024
+                       ) -> Optional[transmit.TransmitStats]:
+        """
+        Process packets by selected XDP function, passing processed
+        packets to the verifier in chunks of up to chunk packets
+        instead of collecting them.
+        """
+        raise NotImplementedError
+
     @classmethod
     def prepare_class(cls):
         """Initialize the static members of XDPCase."""
         pass
 
+    def record_runtime(self, histogram: runtime_histogram.RuntimeHistogram):
+        """Add run times of processed packets to the test's histogram."""
+        if self.xdp_runtime is None:
+            self.xdp_runtime = runtime_histogram.RuntimeHistogram()
+        self.xdp_runtime.update(histogram)
+
+    @timing.timed("assertions")
     def assertPacketIn(self,
                        packet: Packet,
                        container: Iterable[Packet]):
         """Check that packet is in container."""
-        for i in container:
-            if bytes(packet) == bytes(i):
-                return
-
-        self.fail(f"Packet {_describe_packet(packet)} "
-                  f"unexpectedly not found in "
-                  f"{_describe_packet_container(container)}.")
+        if packet not in PacketIndex(container):
+            self.fail(f"Packet {_describe_packet(packet)} "
+                      f"unexpectedly not found in "
+                      f"{_describe_packet_container(container)}.")
 
+    @timing.timed("assertions")
     def assertPacketsIn(self,
                         packets: Iterable[Packet],
                         container: Iterable[Packet]):
-        """Check that every packet from packets is in container."""
-        container = list(map(bytes, container))
+        """
+        Check that every packet from packets is in container,
+        each occurrence of a packet matching a different captured one.
+        """
+        index = PacketIndex(container)
         for i in packets:
-            self.assertPacketIn(i, container)
-            container.remove(bytes(i))
+            if not index.consume(i):
+                self.fail(f"Packet {_describe_packet(i)} "
+                          f"unexpectedly not found in "
+                          f"{_describe_packet_container(container)}.")
 
+    @timing.timed("assertions")
     def assertPacketNotIn(self,
                           packet: Packet,
                           container: Iterable[Packet]):
         """Check that packet is not in container."""
-        for i in container:
-            if bytes(packet) == bytes(i):
-                self.fail(f"Packet {_describe_packet(packet)} "
-                          f"unexpectedly found in "
-                          f"{_describe_packet_container(container)}.")
+        self.assertPacketsNotIn([packet], container)
 
+    @timing.timed("assertions")
     def assertPacketsNotIn(self,
                            packets: Iterable[Packet],
                            container: Iterable[Packet]):
         """Check that no packet from packets is in container."""
+        index = PacketIndex(container)
         for i in packets:
-            self.assertPacketNotIn(i, container)
+            if i in index:
+                self.fail(f"Packet {_describe_packet(i)} "
+                          f"unexpectedly found in "
+                          f"{_describe_packet_container(container)}.")
 
+    @timing.timed("assertions")
     def assertPacketContainerEmpty(self, container: Iterable[Packet]):
         """Check that the container is empty."""
         if len(container) == 0:
             return
 
+        if isinstance(container, packet_counter.CountedCapture):
+            self.fail(f"{_describe_packet_container(container)} "
+                      f"expected to be empty.")
+
         self.fail(f"Packet {_describe_packet(container[0])} "
                   f"found in list expected to be empty.")
 
+    def assertStreamVerified(self, stream_verifier: verifier.StreamVerifier):
+        """Check that the verifier accepted all streamed packets."""
+        failure = stream_verifier.failure()
+        if failure is not None:
+            self.fail(failure)
+
     @classmethod
     def generate_default_packets(
             cls,
@@ -210,28 +330,72 @@ class XDPCase(unittest.TestCase):
         ]
         return [Ether(p.build()) for p in to_send]
 
+    @classmethod
+    def generate_template_packets(
+            cls,
+            count: int,
+            src_port: int = 50000, dst_port: int = 50000,
+            layer_4: str = "udp",
+            use_inet6: bool = False,
+            first_seq: int = 0,
+    ) -> "packet_template.FrameBatch":
+        """
+        Generate raw frames from a template using context, numbered
+        by sequence numbers. Addresses and ports of individual frames
+        can be changed by patch of the returned batch.
+        """
+        # Imported here, so that NumPy is only required by templates.
+        from . import packet_template
+
+        dst_ctx = cls.get_contexts().get_local_main()
+        src_ctx = cls.get_contexts().get_remote_main()
+
+        if use_inet6:
+            (src_inet, dst_inet) = (src_ctx.inet6, dst_ctx.inet6)
+        else:
+            (src_inet, dst_inet) = (src_ctx.inet, dst_ctx.inet)
+        assert(src_inet is not None and dst_inet is not None)
+
+        return packet_template.generate(
+            count, src_ctx.ether, dst_ctx.ether, src_inet, dst_inet,
+            src_port, dst_port, layer_4, use_inet6, first_seq
+        )
+
 
 class XDPCaseBPTR(XDPCase):
+    # Number of processes running packets, set by the client.
+    jobs = 1
+    # Smallest number of packets run by processes instead of this one.
+    PARALLEL_THRESHOLD = 4096
+    # Number of test runs after which redirect events are read
+    # from the ring buffer, before it fills up.
+    DRAIN_PERIOD = 16384
+
     @classmethod
     def setUpClass(cls):
         cls.__fd = None
+        cls.__prog_id = None
         cls.__prog = None
+        cls.__pool = None
 
     @classmethod
-    def prepare_class(cls):
-        cls.probe_counter = BPF(src_file="harness/bptr_probe_counter.c")
+    def tearDownClass(cls):
+        if cls.__pool is not None:
+            cls.__pool.close()
+            cls.__pool = None
 
-        # Using kprobes since tracepoints do not get activated with bptr.
-        cls.probe_counter.attach_kprobe(event=b"bpf_xdp_redirect_map",
-                                        fn_name=b"bpf_xdp_redirect_map")
-        cls.probe_counter.attach_kprobe(event=b"bpf_xdp_redirect",
-                                        fn_name=b"bpf_xdp_redirect")
+    @classmethod
+    def prepare_class(cls):
+        cls.runner = BPTRRunner()
+        cls.redirect_probe = redirect_events.RedirectProbe()
 
     @classmethod
+    @timing.timed("load_bpf")
     def load_bpf(cls, *args, **kwargs):
-        cls.__prog = BPF(*args, **kwargs)
+        cls.__prog = bpf_cache.load_bpf(*args, **kwargs)
         return cls.__prog
 
+    @timing.timed("attach_xdp")
     def attach_xdp(self, section):
         if self.__prog is None:
             self.fail(
@@ -239,7 +403,9 @@ class XDPCaseBPTR(XDPCase):
             )
 
         self.__fd = self.__prog.load_func(section.encode(), BPF.XDP).fd
+        self.__prog_id = bpf_syscall.prog_id(self.__fd)
 
+    @timing.timed("send_packets")
     def send_packets(self, packets):
         passed = []
         redirected = [[] for i in range(self.get_contexts().server_count())]
@@ -249,44 +415,81 @@ class XDPCaseBPTR(XDPCase):
                 "Sending packets without attaching an XDP program."
             )
 
-        for i in packets:
-            (ret_val, pkt) = _prog_test_run(self.__fd, i)
+        results = self.__run(packets)
+        # Targets of all redirects are read at once, after the runs.
+        events = self.redirect_probe.collect()
+
+        runtime = runtime_histogram.RuntimeHistogram()
+        for (ret_val, pkt, duration, run) in results:
+            runtime.add(duration)
 
             if ret_val == BPF.XDP_PASS:
                 passed.append(pkt)
             elif ret_val == BPF.XDP_TX:
                 redirected[0].append(pkt)
             elif ret_val == BPF.XDP_REDIRECT:
-                self.__handle_redirect(pkt, passed, redirected)
+                self.handle_redirect(events.get(run), pkt,
+                                     passed, redirected)
             elif ret_val == BPF.XDP_ABORTED:
                 pass
             elif ret_val == BPF.XDP_DROP:
                 pass
 
-        return SendResult(passed, redirected)
+        if self.measure_runtime:
+            self.record_runtime(runtime)
 
-    def __handle_redirect(self, pkt, passed, redirected):
-        redirect_activated = self.probe_counter[b"redirect_activated"][0]
-        redirect_map_activated = self.probe_counter[b"redirect_map_activated"][0]
-        if redirect_activated == redirect_map_activated:
-            self.fail("Unexpectedly, both or neither map "
-                      "or regular redirect got activated.")
-
-        if redirect_activated:
-            redirect_info = self.probe_counter[b"redirect_info"][0]
+        return SendResult(passed, redirected)
 
-            ifindex = redirect_info.ifindex
-            ifindex = self.get_contexts().iface_index_to_id(ifindex)
+    def __run(self, packets) -> List[bptr_pool.RunResult]:
+        """
+        Run packets through the program, using worker processes
+        for many packets, and identify every test run.
+        """
+        packets = list(packets)
+        if self.jobs > 1 and len(packets) >= self.PARALLEL_THRESHOLD:
+            cls = type(self)
+            if cls.__pool is None or cls.__pool.prog_id != self.__prog_id:
+                if cls.__pool is not None:
+                    cls.__pool.close()
+                cls.__pool = bptr_pool.BPTRPool(self.__fd, self.jobs,
+                                                self.redirect_probe.runs)
+            return cls.__pool.run(packets, self.redirect_probe.drain)
+
+        pid_tgid = redirect_events.current_thread()
+        seq = self.redirect_probe.sequence(pid_tgid)
+        results = []
+        for (i, packet) in enumerate(packets, 1):
+            (ret_val, out, duration) = self.runner.run(self.__fd, packet)
+            results.append((ret_val, bytes(out), duration,
+                            (pid_tgid, seq + i)))
+            if i % self.DRAIN_PERIOD == 0:
+                self.redirect_probe.drain()
+        return results
+
+    def stream_packets(self, packets, stream_verifier, chunk=1024):
+        packets = list(packets)
+        for first in range(0, len(packets), chunk):
+            result = self.send_packets(packets[first:first + chunk])
+            stream_verifier.feed(verifier.LOCAL, result.captured_local)
+            for (i, captured) in enumerate(result.captured_remote):
+                stream_verifier.feed(i, captured)
+        return None
+
+    def handle_redirect(self, event: Optional[redirect_events.RedirectEvent],
+                        pkt, passed, redirected):
+        """Add a redirected packet to the captures of its target."""
+        if event is None:
+            self.fail("Unexpectedly, a packet got redirected "
+                      "without calling a redirect helper.")
+
+        if event.kind == redirect_events.REDIRECT:
+            ifindex = self.get_contexts().iface_index_to_id(event.ifindex)
 
             redirected[ifindex].append(pkt)
-        elif redirect_map_activated:
-            redirect_map_info = self.probe_counter[b"redirect_map_info"][0]
-
-            map_type = utils.BPFMapType(redirect_map_info.map_type)
+        elif event.kind == redirect_events.REDIRECT_MAP:
+            map_type = utils.BPFMapType(event.map_type)
             if map_type == utils.BPFMapType.BPF_MAP_TYPE_DEVMAP:
-                ifindex = redirect_map_info.ifindex
-                map_name = redirect_map_info.map_name
-                ifindex = self.__prog[map_name][ifindex].value
+                ifindex = self.__prog[event.map_name][event.ifindex].value
                 ifindex = self.get_contexts().iface_index_to_id(ifindex)
 
                 redirected[ifindex].append(pkt)
@@ -301,14 +504,15 @@ class XDPCaseBPTR(XDPCase):
 
 
 class XDPCaseNetwork(XDPCase):
+    # Packets are sent to and from servers as raw frames, not pickled.
+    wire_format = wire.WireFormat.FRAMES
+
     @classmethod
     def setUpClass(cls):
         cls.__prog = None
 
-        cls.__pass_prog = BPF(text=b"""
-        int pass_all(struct xdp_md *ctx) { return XDP_PASS; }
-        """)
-        cls.__pass_fn = cls.__pass_prog.load_func(b"pass_all", BPF.XDP)
+        (cls.__pass_prog, cls.__pass_fn) = \
+            utils.load_verdict_prog("pass_all", "XDP_PASS")
 
         main_ctx = cls.get_contexts().get_local_main()
         for i in range(cls.get_contexts().server_count()):
@@ -320,10 +524,20 @@ class XDPCaseNetwork(XDPCase):
                                        cls.__pass_fn,
                                        ctx.xdp_mode)
 
+        cls.runtime_probe = None
+        if cls.measure_runtime:
+            cls.runtime_probe = runtime_histogram.RuntimeProbe(
+                main_ctx.iface, main_ctx.xdp_mode
+            )
+
         return super().setUpClass()
 
     @classmethod
     def tearDownClass(cls):
+        if cls.runtime_probe is not None:
+            cls.runtime_probe.close()
+            cls.runtime_probe = None
+
         if cls.__prog is None:
             return
 
@@ -334,26 +548,40 @@ class XDPCaseNetwork(XDPCase):
     @classmethod
     def prepare_class(cls):
         ctx = cls.get_contexts()
+        cls.sessions = session.SessionPool(ctx.comms)
         for i in range(ctx.server_count()):
             try:
-                conn = cls.__connect(ctx.comms[i], 20)
-                conn.send((utils.ServerCommand.INTRODUCE, ))
-                remote = conn.recv()
+                cls.sessions[i].connect(20)
+                remote = cls.sessions[i].request(
+                    (utils.ServerCommand.INTRODUCE, )
+                )
                 # Custom context is prefered.
                 # if ctx.remotes[i] is None:
                 ctx.remotes[i] = remote
-                conn.close()
             except Exception as exception:
                 raise RuntimeError("Could not contact server.",
                                    ctx.comms[i]) from exception
 
             ctx.get_local(i).fill_missing()
 
+        cls.packet_counter = None
+        if cls.use_counters:
+            cls.packet_counter = packet_counter.PacketCounter(
+                ctx.get_local_main().iface
+            )
+            # The classifier is removed at the end of the run.
+            atexit.register(cls.packet_counter.close)
+
+        # Kprobes are attached for every test class, see setUpClass.
+        cls.runtime_probe = None
+
     @classmethod
+    @timing.timed("load_bpf")
     def load_bpf(cls, *args, **kwargs):
-        cls.__prog = BPF(*args, **kwargs)
+        cls.__prog = bpf_cache.load_bpf(*args, **kwargs)
         return cls.__prog
 
+    @timing.timed("attach_xdp")
     def attach_xdp(self, section):
         if self.__prog is None:
             self.fail(
@@ -366,46 +594,174 @@ class XDPCaseNetwork(XDPCase):
             self.get_contexts().get_local_main().xdp_mode
         )
 
+    @timing.timed("send_packets")
     def send_packets(self, packets):
-        sniffer = utils.wait_for_async_sniffing(
-            iface=self.get_contexts().get_local_main().iface
-        )
-
-        conn_list = []
-        for comm in self.get_contexts().comms:
-            conn_list.append(self.__connect(comm))
-        main_conn = conn_list[0]
-
-        for conn in conn_list[1:]:
-            conn.send((utils.ServerCommand.WATCH, ))
-        main_conn.send((utils.ServerCommand.SEND, packets))
+        main_session = self.sessions[0]
+        watch_sessions = self.sessions.sessions[1:]
+
+        counted = self.use_counters and self.supports_counters
+        if counted:
+            (packets, tags) = packet_counter.tag_packets(packets)
+
+        sniffer = None
+        try:
+            with timing.phase("connect"):
+                for server_session in self.sessions:
+                    server_session.connect()
+
+            with timing.phase("sniffer_start"):
+                if counted:
+                    self.packet_counter.clear()
+                else:
+                    sniffer = capture.start_capture(
+                        self.get_contexts().get_local_main().iface
+                    )
+
+                if self.runtime_probe is not None:
+                    self.runtime_probe.clear()
+
+                for watch_session in watch_sessions:
+                    watch_session.send((utils.ServerCommand.WATCH,
+                                        self.wire_format, counted))
+                for watch_session in watch_sessions:
+                    self.__expect_response(watch_session.recv(),
+                                           utils.ServerResponse.STARTED)
+
+            with timing.phase("send"):
+                main_session.send((utils.ServerCommand.SEND, self.wire_format,
+                                   counted))
+                main_session.send_packets(packets, self.wire_format)
+
+                # Packets are being send here.
+
+                response = main_session.recv()
+                if not isinstance(response, tuple):
+                    self.__expect_response(response,
+                                           utils.ServerResponse.FINISHED)
+                self.__expect_response(response[0],
+                                       utils.ServerResponse.FINISHED)
+                tx_stats = response[1]
+
+            with timing.phase("collect"):
+                # Every capture waits for the end of the burst on its own,
+                # the servers and the client at the same time.
+                for server_session in self.sessions:
+                    server_session.send(utils.ServerCommand.STOP)
+                if counted:
+                    local_counts = self.packet_counter.wait_for_end()
+                    local_results = packet_counter.CountedCapture(
+                        local_counts.counts, local_counts.overflow, tags
+                    )
+                    server_results = [
+                        packet_counter.CountedCapture(*s.recv_counts(), tags)
+                        for s in self.sessions
+                    ]
+                else:
+                    local_results = utils.stop_sniffing(sniffer)
+                    server_results = [s.recv_packets(self.wire_format)
+                                      for s in self.sessions]
+        except BaseException:
+            self.__abort_exchange(sniffer)
+            raise
+
+        if self.runtime_probe is not None:
+            self.record_runtime(self.runtime_probe.read())
+
+        if counted:
+            for result in [local_results] + server_results:
+                if result.overflow:
+                    self.fail(f"{result.overflow} packets were not counted, "
+                              f"more than {packet_counter.MAX_TAGS} "
+                              f"distinct packets were sent.")
+
+        return SendResult(local_results, server_results, tx_stats)
+
+    @timing.timed("send_packets")
+    def stream_packets(self, packets, stream_verifier, chunk=1024):
+        main_session = self.sessions[0]
+        watch_sessions = self.sessions.sessions[1:]
+        fmt = wire.WireFormat.FRAMES
+
+        # Local frames arrive from the capture's thread.
+        lock = threading.Lock()
+
+        def feed(interface, frames):
+            with lock:
+                stream_verifier.feed(interface, frames)
+
+        sniffer = None
+        try:
+            for server_session in self.sessions:
+                server_session.connect()
+
+            sniffer = capture.start_capture(
+                self.get_contexts().get_local_main().iface,
+                functools.partial(feed, verifier.LOCAL)
+            )
 
-        # Packets are being send here.
+            state = {"started": set(), "ended": set(), "tx_stats": None}
+
+            for watch_session in watch_sessions:
+                watch_session.send((utils.ServerCommand.WATCH, fmt,
+                                    False, chunk))
+            self.__pump_streams(feed, state, lambda: len(state["started"]) ==
+                                len(watch_sessions))
+
+            main_session.send((utils.ServerCommand.SEND, fmt, False, chunk))
+            main_session.send_packets(packets, fmt)
+            self.__pump_streams(feed, state,
+                                lambda: state["tx_stats"] is not None)
+
+            for server_session in self.sessions:
+                server_session.send(utils.ServerCommand.STOP)
+            self.__pump_streams(feed, state, lambda: len(state["ended"]) ==
+                                len(self.sessions))
+            utils.stop_sniffing(sniffer)
+        except BaseException:
+            self.__abort_exchange(sniffer)
+            raise
+
+        return state["tx_stats"]
+
+    def __pump_streams(self, feed, state, done):
+        """Handle messages from all servers until done returns True."""
+        conns = {s.conn: i for (i, s) in enumerate(self.sessions)}
+        while not done():
+            ready = multiprocessing.connection.wait(
+                list(conns), utils.BURST_TIMEOUT
+            )
+            if not ready:
+                self.fail("Timed out while streaming packets.")
+
+            for conn in ready:
+                i = conns[conn]
+                message = self.sessions[i].receiver.recv(conn)
+                if isinstance(message, Exception):
+                    raise RuntimeError("Remote side failed") from message
+                elif message == utils.ServerResponse.STARTED:
+                    state["started"].add(i)
+                elif not isinstance(message, tuple):
+                    self.__expect_response(message, "frames")
+                elif message[0] == utils.ServerResponse.FINISHED:
+                    state["tx_stats"] = message[1]
+                else:
+                    (flags, frames) = message
+                    feed(i, frames)
+                    if flags & wire.FrameFlag.END:
+                        state["ended"].add(i)
+
+    def __abort_exchange(self, sniffer):
+        """
+        Close connections to all servers after a failed exchange,
+        so that servers waiting in the middle of it stop, and the next
+        exchange does not read its leftovers.
+        """
+        try:
+            utils.abort_sniffing(sniffer)
+        finally:
+            self.sessions.close()
 
-        response = main_conn.recv()
-        if response != utils.ServerResponse.FINISHED:
+    def __expect_response(self, response, expected):
+        if response != expected:
             self.fail(
                 "Unexpected situation while sending packets: " + str(response))
-
-        server_results = []
-        for conn in conn_list:
-            conn.send(utils.ServerCommand.STOP)
-            server_results.append(conn.recv())
-            conn.close()
-
-        if sniffer.running:
-            sniffer.stop()
-
-        return SendResult(sniffer.results, server_results)
-
-    @classmethod
-    def __connect(cls, comm, retry=10):
-        for i in range(retry):
-            try:
-                return multiprocessing.connection.Client(
-                    (comm.inet, comm.port), "AF_INET"
-                )
-            except ConnectionRefusedError as exception:
-                if i == retry - 1:
-                    raise exception
-                time.sleep(0.2)
@@ -0,0 +1,293 @@
+import os
+import enum
+import socket
+import struct
+import ipaddress
+import dataclasses
+from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+from .bpf_syscall import BPFMap
+
+
+DEFAULT_PIN_PATH = "/sys/fs/bpf/xdp-filter"
+
+class RuleFlag(enum.IntFlag):
+    """
+    Flags of a rule, as stored in xdp-filter's maps.
+    Counters of matched packets are stored above the flags.
+    github.com/xdp-project/xdp-tools/blob/master/xdp-filter/common_kern_user.h
+    """
+    SRC = (1 << 0)
+    DST = (1 << 1)
+    TCP = (1 << 2)
+    UDP = (1 << 3)
+
+
+RULE_FLAGS = RuleFlag.SRC | RuleFlag.DST | RuleFlag.TCP | RuleFlag.UDP
+
+"""
+Names of maps of every kind of rule, named after xdp-filter's commands.
+"""
+MAP_NAMES = {
+    "port": ("filter_ports", ),
+    "ip": ("filter_ipv4", "filter_ipv6"),
+    "ether": ("filter_ethernet", ),
+}
+
+
+def parse_mode(mode: str) -> RuleFlag:
+    """Convert a mode, as given to xdp-filter, to flags."""
+    flags = RuleFlag(0)
+    for part in mode.split(","):
+        flags |= RuleFlag[part.strip().upper()]
+    return flags
+
+
+def encode_key(kind: str, address) -> Tuple[str, bytes]:
+    """Return the name of the map and the key of an address."""
+    if kind == "port":
+        return ("filter_ports", struct.pack("=I", int(address)))
+    if kind == "ether":
+        return ("filter_ethernet", bytes.fromhex(address.replace(":", "")))
+    if kind == "ip":
+        address = ipaddress.ip_address(address)
+        if address.version == 4:
+            return ("filter_ipv4", address.packed)
+        return ("filter_ipv6", address.packed)
+    raise ValueError("Unknown kind of rule", kind)
+
+
+def decode_key(map_name: str, key: bytes) -> str:
+    """Return an address, formatted as in xdp-filter's status."""
+    if map_name == "filter_ports":
+        return str(struct.unpack("=I", key)[0])
+    if map_name == "filter_ethernet":
+        return ":".join(format(b, "02x") for b in key)
+    if map_name == "filter_ipv4":
+        return socket.inet_ntop(socket.AF_INET, key)
+    return socket.inet_ntop(socket.AF_INET6, key)
+
+
+def flags_of(value: Optional[bytes]) -> RuleFlag:
+    """Return flags of a rule from its per-CPU value."""
+    if value is None:
+        return RuleFlag(0)
+    return RuleFlag(struct.unpack_from("=Q", value)[0] & int(RULE_FLAGS))
+
+
+def normalize_address(kind: str, address) -> str:
+    """Return an address formatted the same way as in snapshots."""
+    return decode_key(*encode_key(kind, address))
+
+
+@dataclasses.dataclass(frozen=True)
+class Rule:
+    kind: str
+    address: str
+    flags: RuleFlag
+
+
+@dataclasses.dataclass(frozen=True)
+class SnapshotDiff:
+    """Rules added and removed between two snapshots."""
+    added: FrozenSet[Rule]
+    removed: FrozenSet[Rule]
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.removed)
+
+
+@dataclasses.dataclass(frozen=True)
+class FilterSnapshot:
+    """
+    Rules of xdp-filter at one moment, indexed by kind and address.
+    A rule with changed flags is reported by diff as removed and added.
+    """
+    rules: Dict[Tuple[str, str], RuleFlag]
+
+    def get(self, kind: str, address) -> Optional[Rule]:
+        address = normalize_address(kind, address)
+        flags = self.rules.get((kind, address))
+        if flags is None:
+            return None
+        return Rule(kind, address, flags)
+
+    def contains(self, kind: str, address) -> bool:
+        return self.get(kind, address) is not None
+
+    def of_kind(self, kind: str) -> FrozenSet[Rule]:
+        return frozenset(Rule(k, a, f) for ((k, a), f) in self.rules.items()
+                         if k == kind)
+
+    def diff(self, newer: "FilterSnapshot") -> SnapshotDiff:
+        """Return changes leading from this snapshot to a newer one."""
+        old = set(self.rules.items())
+        new = set(newer.rules.items())
+        return SnapshotDiff(
+            frozenset(Rule(k, a, f) for ((k, a), f) in new - old),
+            frozenset(Rule(k, a, f) for ((k, a), f) in old - new),
+        )
+
+
+class XDPFilterMaps:
+    """
+    Rules of a loaded xdp-filter, read and written directly through its
+    maps pinned in bpffs. Every operation is done in bulk, using batched
+    map syscalls when the kernel supports them.
+    """
+    def __init__(self, pin_path: str = DEFAULT_PIN_PATH):
+        self.pin_path = pin_path
+        self.maps: Dict[str, BPFMap] = {}
+
+    def close(self):
+        for bpf_map in self.maps.values():
+            bpf_map.close()
+        self.maps = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get_map(self, map_name: str) -> Optional[BPFMap]:
+        """Open a map, return None if it is not used by loaded features."""
+        if map_name not in self.maps:
+            path = os.path.join(self.pin_path, map_name)
+            if not os.path.exists(path):
+                return None
+            self.maps[map_name] = BPFMap.from_pin(path)
+        return self.maps[map_name]
+
+    def __values(self, bpf_map: BPFMap, flags: int,
+                 previous: Optional[bytes]) -> bytes:
+        """
+        Build a per-CPU value with given flags,
+        keeping counters of the previous value.
+        """
+        count = bpf_map.cpus
+        if previous is None:
+            counters = [0] * count
+        else:
+            counters = [v & ~int(RULE_FLAGS)
+                        for v in struct.unpack(f"={count}Q", previous)]
+        return struct.pack(f"={count}Q", *[c | int(flags) for c in counters])
+
+    def __group_keys(self, kind: str, addresses: Iterable):
+        grouped: Dict[str, List[bytes]] = {}
+        for address in addresses:
+            (map_name, key) = encode_key(kind, address)
+            grouped.setdefault(map_name, []).append(key)
+        return grouped
+
+    def __change(self, kind: str, addresses: Iterable,
+                 add_flags: RuleFlag, remove_flags: RuleFlag):
+        for (map_name, keys) in self.__group_keys(kind, addresses).items():
+            bpf_map = self.get_map(map_name)
+            if bpf_map is None:
+                raise RuntimeError("Map is not loaded, check features",
+                                   map_name)
+
+            # The kernel has no batched lookup by keys, only changed keys
+            # are looked up, instead of reading the whole map.
+            current = {}
+            updates = []
+            deletes = []
+            for key in keys:
+                if key not in current:
+                    current[key] = bpf_map.lookup(key)
+                previous = current[key]
+                flags = RuleFlag((flags_of(previous) | add_flags)
+                                 & ~int(remove_flags))
+                if flags == 0 and not bpf_map.is_array:
+                    if previous is not None:
+                        deletes.append(key)
+                        current[key] = None
+                else:
+                    value = self.__values(bpf_map, flags, previous)
+                    updates.append((key, value))
+                    current[key] = value
+
+            bpf_map.update_batch(updates)
+            bpf_map.delete_batch(deletes)
+
+    def add(self, kind: str, addresses: Iterable, mode: str = "dst",
+            proto: str = "tcp,udp"):
+        """
+        Add rules for addresses of a kind, named as xdp-filter commands:
+        port, ip or ether. Protocols are only used by ports.
+        """
+        flags = parse_mode(mode)
+        if kind == "port":
+            flags |= parse_mode(proto)
+        self.__change(kind, addresses, flags, RuleFlag(0))
+
+    def remove(self, kind: str, addresses: Iterable,
+               flags: RuleFlag = RULE_FLAGS):
+        """Remove flags of rules, rules without any flags are deleted."""
+        self.__change(kind, addresses, RuleFlag(0), flags)
+
+    def list(self, kind: str) -> Dict[str, RuleFlag]:
+        """Return addresses of all rules of a kind and their flags."""
+        rules = {}
+        for map_name in MAP_NAMES[kind]:
+            bpf_map = self.get_map(map_name)
+            if bpf_map is None:
+                continue
+            for (key, value) in bpf_map.items():
+                flags = flags_of(value)
+                if flags:
+                    rules[decode_key(map_name, key)] = flags
+        return rules
+
+    def snapshot(self, kinds: Iterable[str] = MAP_NAMES) -> FilterSnapshot:
+        """Read all rules of given kinds."""
+        rules = {}
+        for kind in kinds:
+            for (address, flags) in self.list(kind).items():
+                rules[(kind, address)] = flags
+        return FilterSnapshot(rules)
+
+    def refresh(self, snapshot: FilterSnapshot, kind: str,
+                addresses: Iterable) -> FilterSnapshot:
+        """
+        Return a snapshot with rules of addresses read again,
+        using a single lookup per address.
+        """
+        rules = dict(snapshot.rules)
+        for address in addresses:
+            (map_name, key) = encode_key(kind, address)
+            bpf_map = self.get_map(map_name)
+            value = bpf_map.lookup(key) if bpf_map is not None else None
+            flags = flags_of(value)
+
+            address = decode_key(map_name, key)
+            if flags:
+                rules[(kind, address)] = flags
+            else:
+                rules.pop((kind, address), None)
+        return FilterSnapshot(rules)
+
+    def contains(self, kind: str, address) -> bool:
+        """Check whether a rule exists, using a single lookup."""
+        (map_name, key) = encode_key(kind, address)
+        bpf_map = self.get_map(map_name)
+        if bpf_map is None:
+            return False
+        return flags_of(bpf_map.lookup(key)) != 0
+
+    def clear(self):
+        """Remove all rules."""
+        for kind in MAP_NAMES:
+            for map_name in MAP_NAMES[kind]:
+                bpf_map = self.get_map(map_name)
+                if bpf_map is None:
+                    continue
+                keys = [k for (k, v) in bpf_map.items()
+                        if flags_of(v)]
+                if bpf_map.is_array:
+                    bpf_map.update_batch(
+                        [(k, self.__values(bpf_map, 0, None)) for k in keys]
+                    )
+                else:
+                    bpf_map.delete_batch(keys)
@@ -0,0 +1,43 @@
+#include <linux/skbuff.h>
+#include <linux/netdevice.h>
+
+
+BPF_PERCPU_ARRAY(start, u64, 1);
+BPF_HISTOGRAM(runtime);
+
+static int enter(struct sk_buff *skb)
+{
+	int zero_value = 0;
+	u64 now = 0;
+
+	if (skb->dev->ifindex == IFINDEX)
+		now = bpf_ktime_get_ns();
+
+	start.update(&zero_value, &now);
+
+	return 0;
+}
+
+int enter_skb_1(struct pt_regs *ctx, struct sk_buff *skb)
+{
+	return enter(skb);
+}
+
+int enter_skb_2(struct pt_regs *ctx, void *rq, struct sk_buff *skb)
+{
+	return enter(skb);
+}
+
+int leave(struct pt_regs *ctx)
+{
+	int zero_value = 0;
+	u64 *started = start.lookup(&zero_value);
+
+	if (started == NULL || *started == 0)
+		return 0;
+
+	runtime.increment(bpf_log2l(bpf_ktime_get_ns() - *started));
+	*started = 0;
+
+	return 0;
+}
@@ -0,0 +1,43 @@
+import ipaddress
+import unittest
+
+import numpy as np
+from scapy.all import Ether, IPv6, UDP
+
+from harness import packet_template
+
+
+class PatchAddresses(unittest.TestCase):
+    def generate(self, count):
+        return packet_template.generate(
+            count, "02:00:00:00:00:01", "02:00:00:00:00:02",
+            "fd00::1", "fd00::2", 50000, 50000, use_inet6=True
+        )
+
+    def test_ether_array(self):
+        batch = self.generate(3)
+        batch.patch(src_ether=np.array([0x020000000010 + i for i in range(3)],
+                                       dtype=np.uint64),
+                    dst_ether=np.array([0x0200000000ff], dtype=np.uint64))
+
+        for (i, frame) in enumerate(batch):
+            packet = Ether(bytes(frame))
+            self.assertEqual(packet.src, f"02:00:00:00:00:{0x10 + i:02x}")
+            self.assertEqual(packet.dst, "02:00:00:00:00:ff")
+
+    def test_inet6_array(self):
+        first = int(ipaddress.IPv6Address("fd00::100"))
+        batch = self.generate(3)
+        batch.patch(src_inet=np.array([first + i for i in range(3)],
+                                      dtype=object),
+                    dst_inet=np.array([first - 1], dtype=object))
+
+        for (i, frame) in enumerate(batch):
+            packet = Ether(bytes(frame))
+            self.assertEqual(packet[IPv6].src, f"fd00::{0x100 + i:x}")
+            self.assertEqual(packet[IPv6].dst, "fd00::ff")
+
+            # Checksums are computed over the patched addresses.
+            rebuilt = packet.copy()
+            del rebuilt[UDP].chksum
+            self.assertEqual(bytes(rebuilt), bytes(frame))
@@ -2,16 +2,20 @@
 
 import os
 import argparse
+import contextlib
 import sys
 
 import config
 
 
 from harness.utils import clean_traffic
-from harness.config_virtual import virtual_ctxs
-from harness.setup import create_virtual_servers_from_list
-from harness.client import start_client
+from harness.topology import Topology
+from harness.client import start_client, start_sharded_client
 from harness.server import start_server
+from harness.bench import start_bench
+from harness.live_bench import start_live_bench
+from harness.filter_bench import (start_filter_bench, FILTER_MODES,
+                                  RULE_COUNTS)
 from harness.xdp_case import (XDPCaseNetwork, XDPCaseBPTR)
 
 
@@ -32,33 +36,106 @@ def run_bptr(unittest_args):
     return res
 
 
-def run_client(unittest_args):
-    """Build virtual servers and start a client using network."""
-    created_servers_procs = []
-    netns = []
+def run_bench(bench_args):
+    """Benchmark XDP programs using BPF_PROG_TEST_RUN."""
+    ctxs = config.remote_server_ctxs
 
-    try:
-        clean_traffic("default")
+    ctxs.get_local_main().xdp_mode = None
+    if ctxs.get_remote_main() is None:
+        print("Bench mode requires the main ContextClient "
+              "to have a predefined remote context.")
+        return -1
 
-        (created_servers_procs, netns) = \
-            create_virtual_servers_from_list(virtual_ctxs, None)
+    return start_bench(ctxs, bench_args)
 
-        for i in range(config.remote_server_ctxs.server_count()):
-            clean_traffic(config.remote_server_ctxs.get_local(i).iface)
 
-        res = start_client(config.remote_server_ctxs,
-                           XDPCaseNetwork, unittest_args)
+@contextlib.contextmanager
+def virtual_servers(netns_suffix=""):
+    """
+    Build virtual servers for the duration of the block,
+    unless a healthy persistent topology can be reused.
+    """
+    ctxs = config.remote_server_ctxs
+    persistent = Topology.load(netns_suffix)
+    if persistent is not None:
+        if persistent.healthy(ctxs):
+            persistent.detach_programs(ctxs)
+            yield
+            return
+        print("Persistent topology is not healthy, building a new one.")
+        persistent.destroy()
+
+    topology = Topology.build(ctxs, netns_suffix)
+    try:
+        yield
     finally:
-        for i in created_servers_procs:
-            try:
-                i.terminate()
-            except KeyboardInterrupt:
-                pass
-        for i in netns:
-            i.close()
-            i.remove()
+        topology.destroy()
+
+
+def run_topology(action):
+    """Build, remove or check the persistent topology of virtual servers."""
+    ctxs = config.remote_server_ctxs
+    topology = Topology.load()
+
+    if action == "up":
+        if topology is not None:
+            if topology.healthy(ctxs):
+                topology.detach_programs(ctxs)
+                print("Topology is already up.")
+                return 0
+            topology.destroy()
+        Topology.build(ctxs, persistent=True)
+        print("Topology is up.")
+    elif action == "down":
+        if topology is None:
+            print("Topology is not up.")
+            return 0
+        topology.destroy()
+        print("Topology is down.")
+    elif action == "status":
+        if topology is None:
+            print("Topology is not up.")
+            return 1
+        for (netns, pid, log) in zip(topology.netns, topology.pids,
+                                     topology.logs):
+            print(f"{netns}: server {pid}, log {log}")
+        if not topology.healthy(ctxs):
+            print("Topology is not healthy.")
+            return 1
+        print("Topology is healthy.")
+    return 0
+
+
+def run_client(unittest_args, jobs=1, shard_id=None):
+    """Build virtual servers and start a client using network."""
+    if jobs > 1:
+        return start_sharded_client(config.remote_server_ctxs,
+                                    XDPCaseNetwork, unittest_args, jobs)
+
+    netns_suffix = "" if shard_id is None else f"_{shard_id}"
+    with virtual_servers(netns_suffix):
+        return start_client(config.remote_server_ctxs,
+                            XDPCaseNetwork, unittest_args)
+
+
+def run_filter_bench(bench_args):
+    """Build virtual servers and benchmark xdp-filter using network."""
+    with virtual_servers():
+        return start_filter_bench(config.remote_server_ctxs, bench_args)
+
+
+def run_live(live_args):
+    """Build virtual servers and benchmark XDP programs using live frames."""
+    with virtual_servers():
+        return start_live_bench(config.remote_server_ctxs, live_args)
 
-    return res
+
+def run_differential(diff_args):
+    """Build virtual servers and compare verdicts of both backends."""
+    # Imported here, so that other commands do not require NumPy.
+    from harness.differential import start_differential
+    with virtual_servers():
+        return start_differential(config.remote_server_ctxs, diff_args)
 
 
 def run_server():
@@ -100,13 +177,177 @@ def parse_args():
     client_parser = type_subparser.add_parser(
         "client", help="Start testing using a network."
     )
+    client_parser.add_argument(
+        "--jobs", "-j", type=int, default=1,
+        help="""Number of topologies, each in its own network namespace,
+        to run test classes on in parallel."""
+    )
+    client_parser.add_argument(
+        "--report", default=None,
+        help="Write a summary of the results to a JSON file."
+    )
+    client_parser.add_argument(
+        "--histograms", action="store_true",
+        help="""Measure run times of the XDP program on the main interface
+        for every test. Log2 histograms are saved in the report."""
+    )
+    client_parser.add_argument(
+        "--counters", action="store_true",
+        help="""Count tagged packets on receiving interfaces instead of
+        capturing them, in test classes supporting it."""
+    )
+    client_parser.add_argument(
+        "--profile", default=None,
+        help="Write time spent in every phase of every test to a JSON file."
+    )
+    client_parser.add_argument(
+        "--slowest", type=int, default=0, metavar="N",
+        help="Print N slowest tests and time spent in every phase."
+    )
+    # Used internally by --jobs to name network namespaces of a shard.
+    client_parser.add_argument("--shard-id", type=int, default=None,
+                               help=argparse.SUPPRESS)
     client_parser.add_argument(test_names[0], **test_names[1])
 
     bptr_parser = type_subparser.add_parser(
         "bptr", help="Start testing using BPF_PROG_TEST_RUN command."
     )
+    bptr_parser.add_argument(
+        "--histograms", action="store_true",
+        help="Measure run times of the XDP program for every test."
+    )
+    bptr_parser.add_argument(
+        "--jobs", "-j", type=int, default=1,
+        help="""Run large sets of packets in this many processes, using
+        the program pinned in bpffs."""
+    )
+    bptr_parser.add_argument(
+        "--profile", default=None,
+        help="Write time spent in every phase of every test to a JSON file."
+    )
+    bptr_parser.add_argument(
+        "--slowest", type=int, default=0, metavar="N",
+        help="Print N slowest tests and time spent in every phase."
+    )
     bptr_parser.add_argument(test_names[0], **test_names[1])
 
+    bench_parser = type_subparser.add_parser(
+        "bench", help="Benchmark XDP programs using BPF_PROG_TEST_RUN command."
+    )
+    bench_parser.add_argument(
+        "progs", nargs="*", default=None,
+        help="C files with XDP functions, all in progs/ if not specified."
+    )
+    bench_parser.add_argument(
+        "--repeat", type=int, default=1000,
+        help="Number of repetitions of every test run."
+    )
+    bench_parser.add_argument(
+        "--rounds", type=int, default=10,
+        help="Number of samples used to compute variance."
+    )
+    bench_parser.add_argument(
+        "--packets", type=int, default=5,
+        help="Number of packets of every shape in the corpus."
+    )
+    bench_parser.add_argument(
+        "--cflags", action="append", default=[],
+        help="Flags passed to the compiler of the programs."
+    )
+    bench_parser.add_argument(
+        "--xdp-filter", metavar="IFACE", default=None,
+        help="Also benchmark xdp-filter, loaded on the given interface."
+    )
+    bench_parser.add_argument(
+        "--csv", default=None, help="Write the results to a CSV file."
+    )
+
+    filter_bench_parser = type_subparser.add_parser(
+        "filter-bench",
+        help="Benchmark xdp-filter with growing number of rules using network."
+    )
+    filter_bench_parser.add_argument(
+        "--modes", type=lambda s: s.split(","), default=list(FILTER_MODES),
+        help="Comma separated modes to load xdp-filter in."
+    )
+    filter_bench_parser.add_argument(
+        "--rules", type=lambda s: [int(i) for i in s.split(",")],
+        default=list(RULE_COUNTS),
+        help="Comma separated numbers of rules of every kind."
+    )
+    filter_bench_parser.add_argument(
+        "--packets", type=int, default=100000,
+        help="Number of packets sent in every configuration."
+    )
+    filter_bench_parser.add_argument(
+        "--csv", default=None, help="Write the results to a CSV file."
+    )
+
+    live_parser = type_subparser.add_parser(
+        "live", help="""Benchmark XDP functions with traffic generated by
+        a server using BPF_PROG_TEST_RUN command with live frames."""
+    )
+    live_parser.add_argument("prog", help="C file with the XDP functions.")
+    live_parser.add_argument("functions", nargs="+",
+                             help="Names of the XDP functions.")
+    live_parser.add_argument(
+        "--cflags", action="append", default=[],
+        help="Flags passed to the compiler of the program."
+    )
+    live_parser.add_argument(
+        "--packets", type=int, default=64,
+        help="Number of distinct packets sent, "
+             "at most as many as packets counted by tags (65536)."
+    )
+    live_parser.add_argument(
+        "--repeat", type=int, default=100000,
+        help="Number of times every packet is sent."
+    )
+    live_parser.add_argument(
+        "--csv", default=None, help="Write the results to a CSV file."
+    )
+
+    topology_parser = type_subparser.add_parser(
+        "topology", help="""Manage virtual servers kept between runs,
+        reused by other commands while healthy."""
+    )
+    topology_parser.add_argument("action", choices=("up", "down", "status"))
+
+    diff_parser = type_subparser.add_parser(
+        "diff", help="""Compare results of BPF_PROG_TEST_RUN command and
+        network on randomly generated packets."""
+    )
+    diff_parser.add_argument("prog", help="C file with the XDP function.")
+    diff_parser.add_argument("function", help="Name of the XDP function.")
+    diff_parser.add_argument(
+        "--cflags", action="append", default=[],
+        help="Flags passed to the compiler of the program."
+    )
+    diff_parser.add_argument(
+        "--cases", type=int, default=1000000,
+        help="Number of packets to compare."
+    )
+    diff_parser.add_argument(
+        "--batch", type=int, default=10000,
+        help="Number of packets sent through network at once."
+    )
+    diff_parser.add_argument(
+        "--jobs", "-j", type=int, default=os.cpu_count(),
+        help="Number of processes running BPF_PROG_TEST_RUN command."
+    )
+    diff_parser.add_argument(
+        "--seed", type=int, default=0,
+        help="Seed of the random generator of packets."
+    )
+    diff_parser.add_argument(
+        "--output", default=None,
+        help="Write every mismatch to a file, as JSON lines."
+    )
+    diff_parser.add_argument(
+        "--max-reports", type=int, default=100,
+        help="Number of mismatches printed."
+    )
+
     return parser.parse_args()
 
 
@@ -119,13 +360,63 @@ def main():
         sys.exit(-1)
 
     if args.type == "client":
-        unittest_args = {"tests": args.tests}
-        res = run_client(unittest_args)
+        unittest_args = {"tests": args.tests, "report": args.report,
+                         "histograms": args.histograms,
+                         "counters": args.counters,
+                         "profile": args.profile, "slowest": args.slowest}
+        res = run_client(unittest_args, args.jobs, args.shard_id)
     elif args.type == "server":
         run_server()
     elif args.type == "bptr":
-        unittest_args = {"tests": args.tests}
+        unittest_args = {"tests": args.tests,
+                         "histograms": args.histograms,
+                         "bptr_jobs": args.jobs,
+                         "profile": args.profile, "slowest": args.slowest}
         res = run_bptr(unittest_args)
+    elif args.type == "bench":
+        bench_args = {
+            "progs": args.progs,
+            "repeat": args.repeat,
+            "rounds": args.rounds,
+            "packets": args.packets,
+            "cflags": args.cflags,
+            "xdp_filter": args.xdp_filter,
+            "csv": args.csv,
+        }
+        res = run_bench(bench_args)
+    elif args.type == "live":
+        live_args = {
+            "prog": args.prog,
+            "functions": args.functions,
+            "cflags": args.cflags,
+            "packets": args.packets,
+            "repeat": args.repeat,
+            "csv": args.csv,
+        }
+        res = run_live(live_args)
+    elif args.type == "topology":
+        res = run_topology(args.action)
+    elif args.type == "diff":
+        diff_args = {
+            "prog": args.prog,
+            "function": args.function,
+            "cflags": args.cflags,
+            "cases": args.cases,
+            "batch": args.batch,
+            "jobs": args.jobs,
+            "seed": args.seed,
+            "output": args.output,
+            "max_reports": args.max_reports,
+        }
+        res = 1 if run_differential(diff_args) else 0
+    elif args.type == "filter-bench":
+        bench_args = {
+            "modes": args.modes,
+            "rules": args.rules,
+            "packets": args.packets,
+            "csv": args.csv,
+        }
+        res = run_filter_bench(bench_args)
 
     sys.exit(res)
 
@@ -6,6 +6,7 @@ import bcc
 from scapy.all import Ether
 
 from harness.xdp_case import XDPCase
+from harness import verifier
 
 
 class ReturnValuesBasic(XDPCase):
@@ -69,6 +70,47 @@ class ReturnValuesBasic(XDPCase):
             self.assertPacketContainerEmpty(i)
 
 
+class ReturnValuesStream(XDPCase):
+    """Streams a burst larger than a chunk, verifying it chunk by chunk."""
+    CHUNK = 256
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+
+        cls.prog = cls.load_bpf(b"progs/return_values.c")
+
+        cls.to_send = cls.generate_default_packets(amount=4 * cls.CHUNK + 1)
+
+    def test_pass_expected(self):
+        self.attach_xdp("pass_all")
+
+        stream_verifier = verifier.ExpectedSetVerifier(self.to_send)
+        self.stream_packets(self.to_send, stream_verifier, self.CHUNK)
+
+        self.assertStreamVerified(stream_verifier)
+
+    def test_pass_counted(self):
+        self.attach_xdp("pass_all")
+
+        counter = verifier.CountingVerifier()
+        self.stream_packets(self.to_send, counter, self.CHUNK)
+
+        self.assertStreamVerified(counter)
+        self.assertEqual(counter.packets[verifier.LOCAL], len(self.to_send))
+        self.assertEqual(counter.bytes[verifier.LOCAL],
+                         sum(len(bytes(p)) for p in self.to_send))
+        self.assertEqual(sum(counter.packets.values()), len(self.to_send))
+
+    def test_drop_counted(self):
+        self.attach_xdp("drop_all")
+
+        counter = verifier.CountingVerifier()
+        self.stream_packets(self.to_send, counter, self.CHUNK)
+
+        self.assertEqual(sum(counter.packets.values()), 0)
+
+
 class HelperFunctionsAdjustSize(XDPCase):
     @classmethod
     def setUpClass(cls):
@@ -10,10 +10,19 @@ from scapy.all import (Ether, Packet, IP, IPv6, Raw,
 
 from harness.xdp_case import XDPCase, usingCustomLoader
 from harness.utils import XDPFlag
+from harness.xdp_filter import (XDPFilterMaps, FilterSnapshot,
+                                normalize_address, parse_mode)
 
 # XDP_FILTER_EXEC = "progs/xdp-filter-exec.sh"
 XDP_FILTER_EXEC = "xdp-filter"
 
+# Headers of tables of rules in the output of 'xdp-filter status'.
+STATUS_SECTIONS = {
+    "Filtered ports:": "port",
+    "Filtered IP addresses:": "ip",
+    "Filtered MAC addresses:": "ether",
+}
+
 
 def get_mode_string(xdp_mode: XDPFlag):
     if xdp_mode == XDPFlag.SKB_MODE:
@@ -25,6 +34,26 @@ def get_mode_string(xdp_mode: XDPFlag):
     return None
 
 
+def read_status() -> FilterSnapshot:
+    """Parse rules from the output of 'xdp-filter status'."""
+    output = subprocess.check_output([XDP_FILTER_EXEC, "status"])
+    rules = {}
+    kind = None
+    for line in output.decode().splitlines():
+        if not line.strip():
+            continue
+        if not line.startswith(" "):
+            kind = STATUS_SECTIONS.get(line.strip())
+            continue
+        fields = line.split()
+        # Rows are the address, the mode and the hit counter.
+        if kind is None or len(fields) != 3 or not fields[2].isdigit():
+            continue
+        address = normalize_address(kind, fields[0])
+        rules[(kind, address)] = parse_mode(fields[1])
+    return FilterSnapshot(rules)
+
+
 @usingCustomLoader
 class LoadUnload(XDPCase):
     def setUp(self):
@@ -78,6 +107,16 @@ class LoadUnload(XDPCase):
 
 @usingCustomLoader
 class Base(XDPCase):
+    """
+    xdp-filter is loaded once per class and its rules are removed
+    between tests. Classes setting reload_per_test load and unload
+    it for every test instead. xdp-filter never modifies packets,
+    so they can be counted instead of captured.
+    """
+    policy = "allow"
+    reload_per_test = False
+    supports_counters = True
+
     @classmethod
     def setUpClass(cls):
         super().setUpClass()
@@ -89,6 +128,35 @@ class Base(XDPCase):
         cls.to_send6 = cls.generate_default_packets(
             src_port=cls.src_port, dst_port=cls.dst_port, use_inet6=True)
 
+        if not cls.reload_per_test:
+            cls.load_filter()
+            cls.filter_maps = XDPFilterMaps()
+
+    @classmethod
+    def tearDownClass(cls):
+        if not cls.reload_per_test:
+            cls.filter_maps.close()
+            cls.unload_filter()
+
+        super().tearDownClass()
+
+    @classmethod
+    def load_filter(cls):
+        subprocess.check_output([
+            XDP_FILTER_EXEC, "load",
+            "--policy", cls.policy,
+            cls.get_contexts().get_local_main().iface,
+            "--mode", get_mode_string(
+                cls.get_contexts().get_local_main().xdp_mode
+            )
+        ], stderr=subprocess.STDOUT)
+
+    @classmethod
+    def unload_filter(cls):
+        subprocess.check_output([
+            XDP_FILTER_EXEC, "unload", "--all"
+        ], stderr=subprocess.STDOUT)
+
     def arrived(self, packets, result):
         self.assertPacketsIn(packets, result.captured_local)
         for i in result.captured_remote:
@@ -100,18 +168,14 @@ class Base(XDPCase):
             self.assertPacketContainerEmpty(i)
 
     def setUp(self):
-        subprocess.check_output([
-            XDP_FILTER_EXEC, "load",
-            self.get_contexts().get_local_main().iface,
-            "--mode", get_mode_string(
-                self.get_contexts().get_local_main().xdp_mode
-            )
-        ], stderr=subprocess.STDOUT)
+        if self.reload_per_test:
+            self.load_filter()
+        else:
+            self.filter_maps.clear()
 
     def tearDown(self):
-        subprocess.check_output([
-            XDP_FILTER_EXEC, "unload", "--all"
-        ], stderr=subprocess.STDOUT)
+        if self.reload_per_test:
+            self.unload_filter()
 
 
 class DirectBase:
@@ -172,15 +236,11 @@ class BaseDst:
 
 
 class BaseInvert:
-    def setUp(self):
-        subprocess.run([
-            XDP_FILTER_EXEC, "load",
-            "--policy", "deny",
-            self.get_contexts().get_local_main().iface,
-            "--mode", get_mode_string(
-                self.get_contexts().get_local_main().xdp_mode
-            )
-        ])
+    """
+    Runs tests of a class with the deny policy, expecting the opposite
+    verdicts. It has to precede Base in the bases to override it.
+    """
+    policy = "deny"
 
     arrived = Base.not_arrived
     not_arrived = Base.arrived
@@ -189,7 +249,7 @@ class BaseInvert:
 class DirectDropSrc(Base, DirectBase, BaseSrc):
     pass
 
-class DirectPassSrc(Base, DirectBase, BaseSrc, BaseInvert):
+class DirectPassSrc(BaseInvert, Base, DirectBase, BaseSrc):
     pass
 
 
@@ -197,7 +257,7 @@ class DirectDropDst(Base, DirectBase, BaseDst):
     pass
 
 
-class DirectPassDst(Base, DirectBase, BaseDst, BaseInvert):
+class DirectPassDst(BaseInvert, Base, DirectBase, BaseDst):
     pass
 
 
@@ -358,7 +418,9 @@ class MaybeOK(Base):
 
 
 class Status(Base):
-    def setUp(self): 
+    reload_per_test = True
+
+    def setUp(self):
         pass
 
     def load(self, features):
@@ -371,10 +433,6 @@ class Status(Base):
             "--features", features,
         ])
 
-    def get_status(self):
-        return subprocess.run(
-            [XDP_FILTER_EXEC, "status"], capture_output=True
-        ).stdout.decode()
 
     def test_ethernet_feature(self):
         self.load("ethernet")
@@ -394,11 +452,36 @@ class Status(Base):
         self.check_status("ip", self.get_contexts().get_local_main().inet)
         self.check_status("port", str(self.dst_port))
 
-    def check_status(self, subcommand, address):
-        self.assertEqual(self.get_status().find(address), -1)
-
-        subprocess.run([XDP_FILTER_EXEC, subcommand, address])
-        self.assertNotEqual(self.get_status().find(address), -1)
+    def test_status_matches_snapshot(self):
+        self.load("all")
+        local = self.get_contexts().get_local_main()
+        subprocess.run([XDP_FILTER_EXEC, "ether", local.ether,
+                        "--mode", "src"])
+        subprocess.run([XDP_FILTER_EXEC, "ip", local.inet,
+                        "--mode", "src,dst"])
+        subprocess.run([XDP_FILTER_EXEC, "port", str(self.dst_port),
+                        "--mode", "dst", "--proto", "udp"])
+
+        with XDPFilterMaps() as maps:
+            snapshot = maps.snapshot()
+        self.assertEqual(len(snapshot.rules), 3)
+        self.assertEqual(read_status(), snapshot)
 
-        subprocess.run([XDP_FILTER_EXEC, subcommand, address, "--remove"])
-        self.assertEqual(self.get_status().find(address), -1)
+    def check_status(self, subcommand, address):
+        with XDPFilterMaps() as maps:
+            empty = maps.snapshot([subcommand])
+            self.assertFalse(empty.contains(subcommand, address))
+
+            subprocess.run([XDP_FILTER_EXEC, subcommand, address])
+            added = maps.refresh(empty, subcommand, [address])
+            diff = empty.diff(added)
+            self.assertEqual({(r.kind, r.address) for r in diff.added},
+                             {(subcommand,
+                               normalize_address(subcommand, address))})
+            self.assertFalse(diff.removed)
+            self.assertEqual(read_status().of_kind(subcommand),
+                             added.of_kind(subcommand))
+
+            subprocess.run([XDP_FILTER_EXEC, subcommand, address, "--remove"])
+            removed = maps.refresh(added, subcommand, [address])
+            self.assertFalse(empty.diff(removed))